@@ -1,21 +1,45 @@
-from datetime import datetime, timedelta
+from datetime import timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from fastapi import HTTPException, status, Depends
+from fastapi import HTTPException, Request, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from app.config import settings
 from app.models import TokenData, UserInDB
 from app.database import get_database
+from app.cache import TTLCache, auth_cache
+from app.http_client import http_client
+import asyncio
+import hashlib
 import httpx
 import json
-
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+import os
+import time
+
+# Password hashing: Argon2id for new hashes, bcrypt kept only to verify legacy hashes
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated=["bcrypt"],
+    argon2__type="ID",
+    argon2__time_cost=settings.password_hash_rounds,
+    argon2__memory_cost=settings.password_hash_memory_kib,
+    argon2__parallelism=1,
+)
+
+# Bounds concurrent password hashes so a burst of logins can't occupy every worker thread
+_hash_semaphore = asyncio.Semaphore(settings.password_hash_max_concurrency or os.cpu_count() or 1)
 
 # JWT token scheme
 security = HTTPBearer()
 
+# Fields needed to hydrate the authenticated user; password_hash never leaves the database
+CURRENT_USER_PROJECTION = {
+    "_id": 0, "id": 1, "email": 1, "name": 1, "provider": 1, "provider_id": 1, "created_at": 1
+}
+
+# Verified tokens, keyed by a digest of the raw token so bearer secrets are not kept in memory
+_token_cache = TTLCache(maxsize=settings.jwt_cache_size, ttl=settings.jwt_expire_minutes * 60)
+
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
@@ -25,14 +49,21 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+async def hash_password(password: str) -> str:
+    """Hash a password in a worker thread, bounded by the hashing semaphore"""
+    async with _hash_semaphore:
+        return await asyncio.to_thread(pwd_context.hash, password)
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
-        expire = datetime.utcnow() + expires_delta
+        lifetime = int(expires_delta.total_seconds())
     else:
-        expire = datetime.utcnow() + timedelta(minutes=settings.jwt_expire_minutes)
+        lifetime = settings.jwt_expire_minutes * 60
     
-    to_encode.update({"exp": expire})
+    # `exp` is a Unix timestamp; compute it directly instead of via datetime
+    to_encode["exp"] = int(time.time()) + lifetime
     encoded_jwt = jwt.encode(to_encode, settings.jwt_secret_key, algorithm=settings.jwt_algorithm)
     return encoded_jwt
 
@@ -44,8 +75,18 @@ def verify_token(token: str) -> TokenData:
         headers={"WWW-Authenticate": "Bearer"},
     )
     
+    cache_key = hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+    token_data = _token_cache.get(cache_key)
+    if token_data is not None:
+        return token_data
+    
     try:
-        payload = jwt.decode(token, settings.jwt_secret_key, algorithms=[settings.jwt_algorithm])
+        payload = jwt.decode(
+            token,
+            settings.jwt_secret_key,
+            algorithms=[settings.jwt_algorithm],
+            options={"require_exp": True, "require_sub": True},
+        )
         user_id: str = payload.get("sub")
         if user_id is None:
             raise credentials_exception
@@ -53,74 +94,113 @@ def verify_token(token: str) -> TokenData:
     except JWTError:
         raise credentials_exception
     
+    # Only successful verifications are cached, and never past the token's own expiry
+    exp = payload.get("exp")
+    if exp is not None:
+        _token_cache.set(cache_key, token_data, expires_at=float(exp))
+    
     return token_data
 
 
 async def get_current_user(
+    request: Request,
     credentials: HTTPAuthorizationCredentials = Depends(security),
     db=Depends(get_database)
 ) -> UserInDB:
-    token_data = verify_token(credentials.credentials)
+    # Resolved once per request; FastAPI's dependency cache covers Depends() users,
+    # request.state covers code that calls this directly within the same request
+    current_user = getattr(request.state, "current_user", None)
+    if current_user is not None:
+        return current_user
     
-    user = await db.users.find_one({"id": token_data.user_id})
-    if user is None:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="User not found"
-        )
+    # Claims are normally decoded once by the bearer-token middleware; HTTPBearer
+    # still guards the route (and documents it) when the header is missing
+    token_data = getattr(request.state, "token_data", None)
+    if token_data is None:
+        token_data = verify_token(credentials.credentials)
+    
+    current_user = auth_cache.get_user_by_id(token_data.user_id)
+    if current_user is None:
+        user = await db.users.find_one({"id": token_data.user_id}, projection=CURRENT_USER_PROJECTION)
+        if user is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="User not found"
+            )
+        
+        current_user = UserInDB.model_validate(user)
+        auth_cache.set_user_by_id(current_user)
     
-    return UserInDB(**user)
+    request.state.current_user = current_user
+    return current_user
 
 
 async def authenticate_user(email: str, password: str, db) -> Optional[UserInDB]:
     user = await db.users.find_one({"email": email, "provider": "email"})
     if not user:
         return None
-    if not verify_password(password, user["password_hash"]):
+    # Hash verification is CPU-bound; run it off the event loop
+    async with _hash_semaphore:
+        verified, new_hash = await asyncio.to_thread(
+            pwd_context.verify_and_update, password, user["password_hash"]
+        )
+    if not verified:
         return None
-    return UserInDB(**user)
+    if new_hash:
+        # Transparently upgrade legacy bcrypt hashes on successful login
+        await db.users.update_one({"id": user["id"]}, {"$set": {"password_hash": new_hash}})
+        user["password_hash"] = new_hash
+        auth_cache.invalidate(email=user["email"])
+    return UserInDB.model_validate(user)
 
 
 async def get_user_by_email(email: str, db) -> Optional[UserInDB]:
+    cached_user = auth_cache.get_user_by_email(email)
+    if cached_user is not None:
+        return cached_user
+    
     user = await db.users.find_one({"email": email})
     if user:
-        return UserInDB(**user)
+        user = UserInDB.model_validate(user)
+        auth_cache.set_user_by_email(user)
+        return user
     return None
 
 
 async def create_user(user_data: dict, db) -> UserInDB:
     user = UserInDB(**user_data)
-    await db.users.insert_one(user.dict())
+    await db.users.insert_one(user.model_dump())
+    auth_cache.invalidate(email=user.email, user_id=user.id)
     return user
 
 
-async def get_google_user_info(access_token: str) -> dict:
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            "https://www.googleapis.com/oauth2/v2/userinfo",
-            headers={"Authorization": f"Bearer {access_token}"}
+async def get_google_user_info(access_token: str, client: Optional[httpx.AsyncClient] = None) -> dict:
+    client = client or http_client.get_client()
+    response = await client.get(
+        "https://www.googleapis.com/oauth2/v2/userinfo",
+        headers={"Authorization": f"Bearer {access_token}"}
+    )
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid Google access token"
         )
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid Google access token"
-            )
-        return response.json()
+    return response.json()
 
 
-async def get_github_user_info(access_token: str) -> dict:
+async def get_github_user_info(access_token: str, client: Optional[httpx.AsyncClient] = None) -> dict:
     """Get user info from GitHub OAuth"""
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            "https://api.github.com/user",
-            headers={"Authorization": f"Bearer {access_token}"}
+    client = client or http_client.get_client()
+    response = await client.get(
+        "https://api.github.com/user",
+        headers={"Authorization": f"Bearer {access_token}"}
+    )
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid GitHub access token"
         )
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid GitHub access token"
-            )
-        return response.json()
+    return response.json()
 
 
 async def get_or_create_oauth_user(provider: str, provider_id: str, email: str, name: str, db) -> UserInDB:
@@ -132,7 +212,7 @@ async def get_or_create_oauth_user(provider: str, provider_id: str, email: str,
     })
     
     if user:
-        return UserInDB(**user)
+        return UserInDB.model_validate(user)
     
     # Check if email already exists with different provider
     existing_user = await db.users.find_one({"email": email})
@@ -0,0 +1,41 @@
+from typing import Optional
+from app.cache import TTLCache
+from app.config import settings
+from app.models import UserInDB
+
+# Bump when the cached model changes shape so stale entries are never read back
+CACHE_VERSION = "v1"
+
+_users = TTLCache(maxsize=settings.user_cache_size, ttl=settings.user_cache_ttl_seconds)
+
+
+def _email_key(email: str) -> str:
+    return f"{CACHE_VERSION}:user_by_email:{email}"
+
+
+def _id_key(user_id: str) -> str:
+    return f"{CACHE_VERSION}:user_by_id:{user_id}"
+
+
+def get_user_by_email(email: str) -> Optional[UserInDB]:
+    return _users.get(_email_key(email))
+
+
+def set_user_by_email(user: UserInDB):
+    _users.set(_email_key(user.email), user)
+
+
+def get_user_by_id(user_id: str) -> Optional[UserInDB]:
+    return _users.get(_id_key(user_id))
+
+
+def set_user_by_id(user: UserInDB):
+    _users.set(_id_key(user.id), user)
+
+
+def invalidate(email: Optional[str] = None, user_id: Optional[str] = None):
+    """Drop cached lookups for a user after it is created or changed"""
+    if email is not None:
+        _users.pop(_email_key(email))
+    if user_id is not None:
+        _users.pop(_id_key(user_id))
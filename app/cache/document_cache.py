@@ -0,0 +1,96 @@
+import logging
+from typing import Optional, Type, TypeVar
+from pydantic import BaseModel
+from redis.exceptions import RedisError
+from app.cache import TTLCache
+from app.config import settings
+from app.models import Invoice, InvoiceStatus, Server, ServerStatus
+from app.redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+# Bump when a cached model changes shape so stale entries are never read back
+CACHE_VERSION = "v1"
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+# Short-lived per-process tier in front of Redis; absorbs bursts of reads of the same document
+_local = TTLCache(maxsize=settings.document_cache_size, ttl=settings.document_cache_local_ttl_seconds)
+
+
+def _key(kind: str, doc_id: str) -> str:
+    return f"{CACHE_VERSION}:{kind}:{doc_id}"
+
+
+async def _get(kind: str, doc_id: str, model: Type[ModelT]) -> Optional[ModelT]:
+    key = _key(kind, doc_id)
+    cached = _local.get(key)
+    if cached is not None:
+        return cached
+
+    # Redis is an optimisation only: on any error fall back to the database
+    try:
+        raw = await redis_client.get_client().get(key)
+    except RedisError as e:
+        logger.warning(f"Document cache read failed for {key}: {e}")
+        return None
+    if raw is None:
+        return None
+
+    cached = model.model_validate_json(raw)
+    _local.set(key, cached)
+    return cached
+
+
+async def _set(kind: str, doc_id: str, value: BaseModel):
+    key = _key(kind, doc_id)
+    _local.set(key, value)
+    try:
+        await redis_client.get_client().set(
+            key, value.model_dump_json(), ex=settings.document_cache_ttl_seconds
+        )
+    except RedisError as e:
+        logger.warning(f"Document cache write failed for {key}: {e}")
+
+
+async def _invalidate(kind: str, doc_id: str):
+    key = _key(kind, doc_id)
+    _local.pop(key)
+    try:
+        await redis_client.get_client().delete(key)
+    except RedisError as e:
+        logger.warning(f"Document cache invalidation failed for {key}: {e}")
+
+
+# Entries are keyed by document id alone so writers that don't know the owner can
+# invalidate them; readers must check user_id on a hit.
+async def get_server(server_id: str) -> Optional[Server]:
+    return await _get("server", server_id, Server)
+
+
+async def set_server(server: Server):
+    # A PENDING read can race the container worker's invalidation when it finishes
+    # and would then be served stale; PENDING servers are polled from the database
+    if server.status == ServerStatus.PENDING:
+        return
+    await _set("server", server.id, server)
+
+
+async def invalidate_server(server_id: str):
+    await _invalidate("server", server_id)
+
+
+async def get_invoice(invoice_id: str) -> Optional[Invoice]:
+    return await _get("invoice", invoice_id, Invoice)
+
+
+async def set_invoice(invoice: Invoice):
+    # Same race as PENDING servers: an unpaid read can land after pay_invoice's
+    # invalidation, so only paid invoices, which no longer change, are cached
+    if invoice.status != InvoiceStatus.PAID:
+        return
+    await _set("invoice", invoice.id, invoice)
+
+
+async def invalidate_invoice(invoice_id: str):
+    await _invalidate("invoice", invoice_id)
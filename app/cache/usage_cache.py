@@ -0,0 +1,45 @@
+import asyncio
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Tuple
+from app.cache import TTLCache
+from app.config import settings
+
+UsageKey = Tuple[str, str, str, str, str]
+
+_usage = TTLCache(maxsize=settings.usage_cache_size, ttl=settings.usage_cache_ttl_seconds)
+# One lock per key being loaded so concurrent polls of the same range share one aggregation
+_loading: Dict[UsageKey, asyncio.Lock] = {}
+
+
+def usage_key(
+    server_id: str, from_date: datetime, to_date: datetime, interval: str, ts_format: str = "iso"
+) -> UsageKey:
+    return (server_id, from_date.isoformat(), to_date.isoformat(), interval, ts_format)
+
+
+async def get_or_load(key: UsageKey, load: Callable[[], Awaitable[bytes]]) -> bytes:
+    """Return the cached usage response body for `key`, running `load` once on a miss"""
+    if not settings.usage_cache_enabled:
+        return await load()
+
+    cached = _usage.get(key)
+    if cached is not None:
+        return cached
+
+    lock = _loading.setdefault(key, asyncio.Lock())
+    try:
+        async with lock:
+            cached = _usage.get(key)
+            if cached is None:
+                cached = await load()
+                _usage.set(key, cached)
+            return cached
+    finally:
+        # Waiters keep their reference; later callers find the cached entry. Only
+        # drop our own lock: a caller arriving after an earlier pop made a new one
+        if _loading.get(key) is lock:
+            del _loading[key]
+
+
+def clear():
+    _usage.clear()
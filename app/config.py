@@ -1,31 +1,44 @@
-from pydantic_settings import BaseSettings
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import Optional, Dict, Any, List
 from datetime import datetime
 import os
 import json
 
 class Settings(BaseSettings):
-    
+    model_config = SettingsConfigDict(extra="ignore")  # Ignore extra environment variables
     
     # Database
     mongodb_url: str = "mongodb://localhost:27017"
     mongodb_database: str = "autobit"
     mongodb_max_connections: int = 100
     mongodb_connection_timeout: int = 5000
+    mongodb_compressors: str = "zstd,snappy"
     
     # Redis
     redis_url: str = "redis://localhost:6379"
     redis_db: int = 0
     redis_max_connections: int = 50
+    redis_socket_timeout: float = 2.0  # seconds; caches fail open rather than stall requests
     
     # NATS
     nats_url: str = "nats://localhost:4222"
     nats_cluster_id: str = "autobit-cluster"
     nats_client_id: str = "autobit-client"
+    nats_max_reconnect_attempts: int = 60
+    nats_reconnect_time_wait: int = 2  # seconds
     
     # JWT
     jwt_secret_key: str = "your-super-secret-jwt-key-change-this-in-production"
     jwt_algorithm: str = "HS256"
+    jwt_cache_size: int = 10000  # verified tokens kept in memory
+    user_cache_size: int = 10000  # user lookups kept in memory
+    user_cache_ttl_seconds: int = 60
+    document_cache_size: int = 10000  # servers/invoices kept in process memory
+    document_cache_local_ttl_seconds: int = 5
+    document_cache_ttl_seconds: int = 300  # Redis tier
+    usage_cache_enabled: bool = True
+    usage_cache_size: int = 4096  # usage query results kept in memory
+    usage_cache_ttl_seconds: int = 60
     
     # OAuth
     google_client_id: Optional[str] = None
@@ -41,6 +54,7 @@ class Settings(BaseSettings):
     smtp_from_email: Optional[str] = None
     smtp_use_tls: bool = True
     smtp_use_ssl: bool = False
+    email_concurrency: int = 20  # weekly reports built and sent at once
     
     # API
     api_host: str = "0.0.0.0"
@@ -48,10 +62,24 @@ class Settings(BaseSettings):
     api_workers: int = 4
     api_max_requests: int = 1000
     
+    # CORS: explicit origins (JSON list in the environment), or a regex compiled once at startup
+    cors_allowed_origins: List[str] = ["http://localhost:3000", "http://localhost:8000"]
+    cors_allow_origin_regex: Optional[str] = None
+    
+    # Rate limiting (per client IP); point the storage at Redis to share counters across workers
+    rate_limit_storage_uri: str = "memory://"
+    rate_limit_auth: str = "5/minute"
+    rate_limit_oauth_callback: str = "10/minute"
+    rate_limit_invoice_generate: str = "2/minute"
+    
     # Docker
     docker_host: str = "unix:///var/run/docker.sock"
     docker_api_version: str = "1.41"
     docker_timeout: int = 30
+    docker_max_concurrency: int = 8  # concurrent blocking calls to the daemon
+    container_worker_concurrency: int = 8  # lifecycle jobs processed at once
+    container_worker_drain_timeout: int = 30  # seconds to finish queued jobs at shutdown
+    container_job_stale_seconds: int = 300  # PENDING this long means the job was lost; re-submit it
     
     # Billing rates (USD per hour)
     vcpu_rate_per_core_hour: float = 0.0100
@@ -60,7 +88,12 @@ class Settings(BaseSettings):
     
     # Usage settings
     usage_sampling_interval: int = 30  # seconds
+    usage_max_sample_gap: Optional[int] = None  # seconds a sample is held at most; defaults to 2x the interval
+    usage_sampling_concurrency: int = 50  # servers sampled at once per tick
     usage_retention_days: int = 90
+    usage_rollup_interval: int = 600  # seconds between hourly rollup runs
+    usage_max_range_days: int = 90  # widest from/to window accepted by the usage endpoint
+    usage_max_points: int = 10000  # cap on samples or buckets returned per usage request
     
     # Server limits
     max_servers_per_user: int = 10
@@ -71,6 +104,9 @@ class Settings(BaseSettings):
     # Security settings
     jwt_expire_minutes: int = 1440  # 24 hours
     password_min_length: int = 8
+    password_hash_rounds: int = 2  # Argon2id time cost
+    password_hash_memory_kib: int = 19456  # Argon2id memory cost
+    password_hash_max_concurrency: Optional[int] = None  # defaults to the CPU count
     max_login_attempts: int = 5
     account_lockout_minutes: int = 30
     
@@ -78,9 +114,6 @@ class Settings(BaseSettings):
     health_check_interval: int = 60  # seconds
     log_level: str = "INFO"
 
-    class Config:
-        extra = "ignore"  # Ignore extra environment variables
-
 # Global instance
 settings = Settings()
 
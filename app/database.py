@@ -1,7 +1,14 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from bson import ObjectId
+from pymongo.errors import OperationFailure
 from app.config import settings
 import asyncio
 
+# MongoDB error codes for index maintenance
+INDEX_NOT_FOUND = 27
+INDEX_OPTIONS_CONFLICT = 85
+INDEX_KEY_SPECS_CONFLICT = 86
+
 
 class Database:
     client: AsyncIOMotorClient = None
@@ -14,10 +21,26 @@ db = Database()
 async def get_database():
     return db.database
 
+
+# Keyset pagination: a page cursor is the ObjectId of the last document returned.
+# Raises bson.errors.InvalidId for malformed cursors.
+def page_query(query: dict, cursor: str = None, descending: bool = False) -> dict:
+    if not cursor:
+        return query
+    return {**query, "_id": {"$lt" if descending else "$gt": ObjectId(cursor)}}
+
  #Create database connection
 async def connect_to_mongo():
    
-    db.client = AsyncIOMotorClient(settings.mongodb_url)
+    db.client = AsyncIOMotorClient(
+        settings.mongodb_url,
+        maxPoolSize=settings.mongodb_max_connections,
+        serverSelectionTimeoutMS=settings.mongodb_connection_timeout,
+        connectTimeoutMS=settings.mongodb_connection_timeout,
+        # Wire compression; codecs the server or client lacks are skipped
+        compressors=settings.mongodb_compressors,
+        uuidRepresentation="standard",
+    )
     db.database = db.client[settings.mongodb_database]
     
     # Create indexes
@@ -31,22 +54,80 @@ async def close_mongo_connection():
 
 # Create database indexes 
 async def create_indexes():
-    # Users collection indexes
-    await db.database.users.create_index("email", unique=True)
-    await db.database.users.create_index("provider_id")
-    
-    # Servers collection indexes
-    await db.database.servers.create_index("user_id")
-    await db.database.servers.create_index("container_id")
-    
-    # Usage samples collection indexes
-    await db.database.usage_samples.create_index([("server_id", 1), ("ts", 1)])
-    await db.database.usage_samples.create_index("ts")
-    
-    # Invoices collection indexes
-    await db.database.invoices.create_index("user_id")
-    await db.database.invoices.create_index([("period_start", 1), ("period_end", 1)])
+    # Index builds on distinct collections are independent; issue them concurrently
+    await asyncio.gather(
+        # Users collection indexes
+        db.database.users.create_index("id", unique=True),
+        db.database.users.create_index("email", unique=True),
+        db.database.users.create_index([("email", 1), ("provider", 1)]),
+        # OAuth lookups filter on both fields; email users have no provider_id
+        db.database.users.create_index(
+            [("provider", 1), ("provider_id", 1)],
+            unique=True,
+            partialFilterExpression={"provider_id": {"$type": "string"}},
+        ),
+        # Superseded by the (provider, provider_id) index
+        drop_index_if_exists(db.database.users, "provider_id_1"),
+        
+        # Servers collection indexes
+        # Lookups by id (alone or with user_id) and the worker's id-only updates
+        db.database.servers.create_index("id", unique=True),
+        db.database.servers.create_index("user_id"),
+        db.database.servers.create_index("container_id"),
+        # Paginated listings walk a user's servers in _id order
+        db.database.servers.create_index([("user_id", 1), ("_id", 1)]),
+        
+        # Usage samples collection indexes
+        db.database.usage_samples.create_index([("server_id", 1), ("ts", 1)]),
+        # TTL index: MongoDB expires samples older than the retention window
+        ensure_index(
+            db.database.usage_samples,
+            "ts",
+            expireAfterSeconds=settings.usage_retention_days * 24 * 60 * 60,
+        ),
+        # Hourly rollups are merged on (server_id, ts), which needs a unique index
+        db.database.usage_samples_1h.create_index([("server_id", 1), ("ts", 1)], unique=True),
+        db.database.usage_samples_1d.create_index([("server_id", 1), ("ts", 1)], unique=True),
+        
+        # Invoices collection indexes
+        db.database.invoices.create_index("id", unique=True),
+        db.database.invoices.create_index("user_id"),
+        db.database.invoices.create_index([("user_id", 1), ("_id", -1)]),
+        # One invoice per user and period, enforced even for concurrent generate requests
+        ensure_index(
+            db.database.invoices,
+            [("user_id", 1), ("period_start", 1), ("period_end", 1)],
+            unique=True,
+        ),
+        # Superseded by the (user_id, period_start, period_end) index
+        drop_index_if_exists(db.database.invoices, "period_start_1_period_end_1"),
+        
+        # Transactions collection indexes
+        db.database.transactions.create_index("invoice_id"),
+        db.database.transactions.create_index("ts"),
+    )
+
+
+# Drop an index left over from an older schema, ignoring it if already gone
+async def drop_index_if_exists(collection, name: str):
+    try:
+        await collection.drop_index(name)
+    except OperationFailure as e:
+        if e.code != INDEX_NOT_FOUND:
+            raise
+
+
+# create_index that rebuilds an existing index on the same keys whose options differ
+# (e.g. a plain index being turned into a TTL index, or a changed retention window)
+async def ensure_index(collection, keys, **options):
+    try:
+        return await collection.create_index(keys, **options)
+    except OperationFailure as e:
+        if e.code not in (INDEX_OPTIONS_CONFLICT, INDEX_KEY_SPECS_CONFLICT):
+            raise
     
-    # Transactions collection indexes
-    await db.database.transactions.create_index("invoice_id")
-    await db.database.transactions.create_index("ts")
+    key_spec = [(keys, 1)] if isinstance(keys, str) else list(keys)
+    for name, info in (await collection.index_information()).items():
+        if list(info["key"]) == key_spec:
+            await collection.drop_index(name)
+    return await collection.create_index(keys, **options)
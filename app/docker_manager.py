@@ -1,7 +1,9 @@
 import docker
 import asyncio
+import functools
 import psutil
-from typing import Optional, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, Set
 from app.config import settings
 from app.models import ServerInDB, ServerStatus
 import logging
@@ -9,6 +11,20 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def calculate_cpu_percent(cpu_stats: Dict[str, Any], previous_cpu_stats: Dict[str, Any]) -> float:
+    """CPU percentage between two `cpu_stats` samples from the Docker stats API"""
+    cpu_usage = cpu_stats.get('cpu_usage', {})
+    previous_cpu_usage = previous_cpu_stats.get('cpu_usage', {})
+
+    cpu_delta = cpu_usage.get('total_usage', 0) - previous_cpu_usage.get('total_usage', 0)
+    system_delta = cpu_stats.get('system_cpu_usage', 0) - previous_cpu_stats.get('system_cpu_usage', 0)
+    if system_delta <= 0 or cpu_delta <= 0:
+        return 0.0
+
+    online_cpus = cpu_stats.get('online_cpus') or len(cpu_usage.get('percpu_usage') or []) or 1
+    return (cpu_delta / system_delta) * online_cpus * 100.0
+
+
 class DockerManager:
     def __init__(self):
         try:
@@ -31,6 +47,22 @@ class DockerManager:
             logger.warning("Running in mock mode. Containers will not be created.")
             self.client = None
             self.available = False
+        
+        # Bounds concurrent blocking calls to the Docker daemon, on threads of their
+        # own so slow daemon calls don't starve the default executor (password hashing)
+        self._semaphore = asyncio.Semaphore(settings.docker_max_concurrency)
+        self._executor = ThreadPoolExecutor(
+            max_workers=settings.docker_max_concurrency, thread_name_prefix="docker"
+        )
+        
+        # Last `cpu_stats` seen per container, used to compute CPU deltas from one-shot samples
+        self._last_cpu_stats: Dict[str, Dict[str, Any]] = {}
+    
+    async def _run(self, func, *args, **kwargs):
+        """Run a blocking docker SDK call on the Docker thread pool"""
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
     
     def get_status(self) -> Dict[str, Any]:
         if not self.available or self.client is None:
@@ -58,7 +90,7 @@ class DockerManager:
             }
 
 
-    async def create_container(self, server: ServerInDB) -> str:
+    async def create_container(self, server: ServerInDB, ensure_image: bool = True) -> str:
         if not self.available or self.client is None:
             logger.warning(
                 f"Docker not available, returning mock container ID for server {server.id}"
@@ -66,41 +98,47 @@ class DockerManager:
             return f"mock-container-{server.id}"
         
         try:
-            # Calculate CPU quota and period
-            cpu_quota = int(server.cpu_limit * 100000)
-            cpu_period = 100000
-
-            # Memory limit in bytes
-            memory_limit = int(server.ram_gib * 1024 * 1024 * 1024)
-
-            image_name = server.image.lower()
-
-            # Ensure image exists locally, pull if missing
-            try:
-                self.client.images.get(image_name)
-                logger.info(f"Image {image_name} found locally")
-            except Exception:
-                logger.info(f"Image {image_name} not found, pulling...")
-                self.client.images.pull(*image_name.split(":", 1))
-
-            # Create container
-            container = self.client.containers.create(
-                image=image_name,
-                name=f"autobit-server-{server.id}",
-                cpu_quota=cpu_quota,
-                cpu_period=cpu_period,
-                mem_limit=memory_limit,
-                memswap_limit=memory_limit,  # Disable swap
-                detach=True,
-                
-            )
-
-            return container.id
+            return await self._run(self._create_container_sync, server, ensure_image)
 
         except Exception as e:
             logger.error(f"Failed to create container for server {server.id}: {e}")
             raise
 
+    def _ensure_image_sync(self, image_name: str):
+        # Ensure image exists locally, pull if missing
+        try:
+            self.client.images.get(image_name)
+            logger.info(f"Image {image_name} found locally")
+        except Exception:
+            logger.info(f"Image {image_name} not found, pulling...")
+            self.client.images.pull(*image_name.split(":", 1))
+
+    def _create_container_sync(self, server: ServerInDB, ensure_image: bool = True) -> str:
+        # Calculate CPU quota and period
+        cpu_quota = int(server.cpu_limit * 100000)
+        cpu_period = 100000
+
+        # Memory limit in bytes
+        memory_limit = int(server.ram_gib * 1024 * 1024 * 1024)
+
+        image_name = server.image.lower()
+        if ensure_image:
+            self._ensure_image_sync(image_name)
+
+        # Create container
+        container = self.client.containers.create(
+            image=image_name,
+            name=f"autobit-server-{server.id}",
+            cpu_quota=cpu_quota,
+            cpu_period=cpu_period,
+            mem_limit=memory_limit,
+            memswap_limit=memory_limit,  # Disable swap
+            detach=True,
+            
+        )
+
+        return container.id
+
 
     
     async def start_container(self, container_id: str) -> bool:
@@ -109,8 +147,8 @@ class DockerManager:
             return True
         
         try:
-            container = self.client.containers.get(container_id)
-            container.start()
+            container = await self._run(self.client.containers.get, container_id)
+            await self._run(container.start)
             return True
         except Exception as e:
             logger.error(f"Failed to start container {container_id}: {e}")
@@ -122,8 +160,8 @@ class DockerManager:
             return True
         
         try:
-            container = self.client.containers.get(container_id)
-            container.stop(timeout=10)
+            container = await self._run(self.client.containers.get, container_id)
+            await self._run(container.stop, timeout=10)
             return True
         except Exception as e:
             logger.error(f"Failed to stop container {container_id}: {e}")
@@ -135,8 +173,9 @@ class DockerManager:
             return True
         
         try:
-            container = self.client.containers.get(container_id)
-            container.remove(force=True)
+            container = await self._run(self.client.containers.get, container_id)
+            await self._run(container.remove, force=True)
+            self._last_cpu_stats.pop(container_id, None)
             return True
         except Exception as e:
             logger.error(f"Failed to delete container {container_id}: {e}")
@@ -148,21 +187,26 @@ class DockerManager:
             logger.warning(f"Docker not available, returning mock stats for container {container_id}")
             return {
                 'cpu_percent': 25.0,  # Mock CPU usage
-                'memory_usage_mb': 512.0,  # Mock memory usage
-                'disk_usage_gb': 1.0  # Mock disk usage
+                'memory_mb': 512.0,  # Mock memory usage
+                'disk_gb': 1.0  # Mock disk usage
             }
         
         try:
-            container = self.client.containers.get(container_id)
-            stats = container.stats(stream=False)
-            
-            # Calculate CPU percentage
-            cpu_delta = stats['cpu_stats']['cpu_usage']['total_usage'] - stats['precpu_stats']['cpu_usage']['total_usage']
-            system_delta = stats['cpu_stats']['system_cpu_usage'] - stats['precpu_stats']['system_cpu_usage']
-            cpu_percent = 0.0
+            # One-shot samples return immediately instead of waiting a full daemon
+            # cycle; the CPU delta is taken against the previous sample we stored.
+            # The first sample for a container still uses the two-cycle read.
+            previous_cpu_stats = self._last_cpu_stats.get(container_id)
+            stats = await self._run(
+                self.client.api.stats,
+                container_id,
+                stream=False,
+                one_shot=previous_cpu_stats is not None,
+            )
             
-            if system_delta > 0 and cpu_delta > 0:
-                cpu_percent = (cpu_delta / system_delta) * len(stats['cpu_stats']['cpu_usage']['percpu_usage']) * 100.0
+            if previous_cpu_stats is None:
+                previous_cpu_stats = stats.get('precpu_stats', {})
+            cpu_percent = calculate_cpu_percent(stats['cpu_stats'], previous_cpu_stats)
+            self._last_cpu_stats[container_id] = stats['cpu_stats']
             
             # memory usage in MB
             memory_usage = stats['memory_stats']['usage'] / (1024 * 1024)
@@ -182,26 +226,46 @@ class DockerManager:
             return None
     
     async def update_container_resources(self, container_id: str, server: ServerInDB) -> Optional[str]:
+        image_task = None
         try:
+            # Verify (or pull) the image while the old container is being torn down
+            if self.available and self.client is not None:
+                image_task = asyncio.create_task(
+                    self._run(self._ensure_image_sync, server.image.lower())
+                )
        
             await self.stop_container(container_id)
             
             await self.delete_container(container_id)
 
-            new_container_id = await self.create_container(server)
+            if image_task is not None:
+                await image_task
+
+            new_container_id = await self.create_container(server, ensure_image=image_task is None)
             
             await self.start_container(new_container_id)
             
             return new_container_id
             
         except Exception as e:
+            if image_task is not None and not image_task.done():
+                image_task.cancel()
             logger.error(f"Failed to update resources for container {container_id}: {e}")
             return None
     
+    async def running_container_ids(self) -> Optional[Set[str]]:
+        """Ids of all running containers from one daemon call, or None if it failed"""
+        try:
+            containers = await self._run(self.client.api.containers, quiet=True)
+            return {container['Id'] for container in containers}
+        except Exception as e:
+            logger.error(f"Failed to list running containers: {e}")
+            return None
+    
     async def is_container_running(self, container_id: str) -> bool:
         """Check if a container is running"""
         try:
-            container = self.client.containers.get(container_id)
+            container = await self._run(self.client.containers.get, container_id)
             return container.status == 'running'
         except Exception as e:
             logger.error(f"Failed to check container status {container_id}: {e}")
@@ -0,0 +1,38 @@
+import httpx
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPClient:
+    def __init__(self):
+        self.client = None
+    
+    # Create the shared client; connections are pooled and kept alive between calls
+    def connect(self) -> httpx.AsyncClient:
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+                timeout=httpx.Timeout(5.0, connect=2.0),
+            )
+            logger.info("Created shared HTTP client")
+        return self.client
+    
+    async def close(self):
+        
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+    
+    def get_client(self) -> httpx.AsyncClient:
+        """Return the shared client, creating it on first use"""
+        return self.connect()
+
+
+http_client = HTTPClient()
+
+
+# FastAPI dependency returning the shared client
+async def get_http_client() -> httpx.AsyncClient:
+    return http_client.get_client()
@@ -1,46 +1,94 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from app.routers import auth, servers, usage, billing, emails
 from app.database import connect_to_mongo, close_mongo_connection
 from app.nats_client import nats_client
+from app.http_client import http_client
+from app.redis_client import redis_client
+from app.workers.container_worker import container_worker
 from app.config import settings
 from app.docker_manager import docker_manager
+from app.auth import verify_token
+from app.rate_limit import limiter
+from slowapi import _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
 import logging
 import time
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 
 # Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await startup_event()
+    yield
+    await shutdown_event()
+
+
 app = FastAPI(
+    lifespan=lifespan,
     title="AutoBit Backend System",
     description="Production-ready backend system for Docker container management with metered billing",
     version="2.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    # orjson encodes every route's response (datetimes natively) instead of the stdlib json
+    default_response_class=ORJSONResponse
 )
 
+# Per-IP rate limits declared on individual routes
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Adjust as needed for production
+    allow_origins=settings.cors_allowed_origins,
+    allow_origin_regex=settings.cors_allow_origin_regex,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Cross-origin clients can only read response headers listed here (list pagination)
+    expose_headers=["X-Next-Cursor"],
 )
 
+# Decode bearer tokens once per request; get_current_user reads the claims from request.state
+@app.middleware("http")
+async def decode_bearer_token(request: Request, call_next):
+    authorization = request.headers.get("Authorization")
+    if authorization:
+        scheme, _, token = authorization.partition(" ")
+        if scheme.lower() == "bearer" and token:
+            try:
+                request.state.token_data = verify_token(token)
+            except HTTPException:
+                # Left unset; routes that need auth reject the token themselves
+                pass
+    return await call_next(request)
+
+# Paths that skip the X-Process-Time header
+UNTIMED_PATHS = frozenset({"/health"})
+
 # Middleware
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
-    start_time = time.time()
+    # Health probes are hot and don't need timing
+    if request.url.path in UNTIMED_PATHS:
+        return await call_next(request)
+    
+    start_time = time.perf_counter()
     try:
         response = await call_next(request)
     except Exception as e:
         logger.error(f"Error processing request: {e}")
-        response = JSONResponse(status_code=500, content={"detail": "Internal Server Error"})
-    process_time = time.time() - start_time
-    response.headers["X-Process-Time"] = str(process_time)
+        response = ORJSONResponse(status_code=500, content={"detail": "Internal Server Error"})
+    process_time = time.perf_counter() - start_time
+    response.headers["X-Process-Time"] = f"{process_time:.6f}"
     return response
 
 # Register all API routers
@@ -51,20 +99,29 @@ app.include_router(billing.router, prefix="/billing", tags=["Billing"])
 app.include_router(emails.router, prefix="/emails", tags=["Emails"])
 
 
-@app.on_event("startup")
 async def startup_event():
     """Application startup event"""
     logger.info("Starting AutoBit Backend System...")
     
     try:
-        # Connect to MongoDB
-        await connect_to_mongo()
-        logger.info("Connected to MongoDB")
+        # Thread pool for blocking work offloaded with asyncio.to_thread (password hashing);
+        # Docker calls run on the docker manager's own pool
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=settings.api_workers * 2)
+        )
+        
+        # MongoDB and NATS handshakes are independent; connect to both concurrently
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(connect_to_mongo())
+            tg.create_task(nats_client.connect())
+        logger.info("Connected to MongoDB and NATS")
         
-        # Connect to NATS
-        await nats_client.connect()
-        logger.info("Connected to NATS")
+        # Shared outbound HTTP client (OAuth providers) and Redis client (OAuth state)
+        http_client.connect()
+        redis_client.connect()
         
+        # Docker lifecycle jobs queued by the server routes
+        container_worker.start()
         
         logger.info("AutoBit Backend System started successfully!")
         
@@ -72,24 +129,26 @@ async def startup_event():
         logger.error(f"Failed to start system: {e}")
         raise
 
-@app.on_event("shutdown")
 async def shutdown_event():
     """Application shutdown event"""
     logger.info("Shutting down AutoBit Backend System...")
     
-    try:
-        # Close MongoDB connection
-        await close_mongo_connection()
-        logger.info("MongoDB connection closed")
-        
-        # Close NATS connection
-        await nats_client.close()
-        logger.info("NATS connection closed")
-        
-        logger.info("AutoBit Backend System shutdown complete")
-        
-    except Exception as e:
-        logger.error(f" Error during shutdown: {e}")
+    # Finish queued container jobs while the database and NATS are still connected
+    await container_worker.stop()
+    
+    # Close MongoDB, NATS and the shared HTTP/Redis clients; one failing doesn't stop the others
+    results = await asyncio.gather(
+        close_mongo_connection(),
+        nats_client.close(),
+        http_client.close(),
+        redis_client.close(),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f" Error during shutdown: {result}")
+    
+    logger.info("AutoBit Backend System shutdown complete")
 
 
 @app.get("/health", tags=["Health"])
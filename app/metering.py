@@ -0,0 +1,345 @@
+"""Usage integration shared by billing and the rollup worker.
+
+Each raw sample's reading is held until the next sample of the same server, for
+at most max_sample_gap() (a longer gap, or no next sample, means the server was
+stopped), so a sample contributes
+- cpu_hours: (cpu_pct / 100) * hours (multiply by the server's cores)
+- ram_gib_hours: (ram_mib / 1024) * hours
+- span_hours: hours covered (multiply by the server's disk size)
+An interval is attributed to the hour (and billing period) it starts in.
+
+Whole hours are pre-integrated into the usage_samples_1h rollup collection by
+app.workers.rollup_worker, and whole days into usage_samples_1d from the hourly
+rollups; rollup_state records how far the hourly collection is complete (the
+daily one is complete up to the start of that day) and the last sample _id the
+worker has seen, so hours that receive samples after being rolled up (backfills,
+late writes) are re-rolled. Rollups also keep sample sums and counts so the
+usage endpoint can serve averages from them. Raw samples remain the source of
+truth: deleting the rollup_state document makes the worker rebuild the rollups
+from the oldest sample.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+from app.config import settings
+
+ROLLUP_COLLECTION = "usage_samples_1h"
+DAILY_ROLLUP_COLLECTION = "usage_samples_1d"
+# Bumped when rollup documents change shape or meaning; a new id makes the worker rebuild them
+ROLLUP_STATE_ID = "usage_rollups.v3"
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+# $group accumulators over held intervals
+INTERVAL_TOTALS = {
+    "cpu_hours": {"$sum": {"$multiply": [{"$divide": ["$cpu_pct", 100]}, "$dt_h"]}},
+    "ram_gib_hours": {"$sum": {"$multiply": [{"$divide": ["$ram_mib", 1024]}, "$dt_h"]}},
+    "span_hours": {"$sum": "$dt_h"}
+}
+
+# $group accumulators for per-bucket sample averages
+SAMPLE_SUMS = {
+    "cpu_pct_sum": {"$sum": "$cpu_pct"},
+    "ram_mib_sum": {"$sum": "$ram_mib"},
+    "disk_gib_sum": {"$sum": "$disk_gib"},
+    "sample_count": {"$sum": 1}
+}
+
+# $group accumulators over rollup documents
+ROLLUP_TOTALS = {field: {"$sum": f"${field}"} for field in INTERVAL_TOTALS}
+ROLLUP_FIELDS = [*INTERVAL_TOTALS, *SAMPLE_SUMS]
+
+# Usage endpoint interval -> (pre-bucketed sample field, equivalent $dateTrunc options)
+BUCKET_FIELDS = {
+    "5m": ("ts_5min", {"unit": "minute", "binSize": 5}),
+    "1h": ("ts_hour", {"unit": "hour"}),
+    "1d": ("ts_day", {"unit": "day"})
+}
+
+
+def max_sample_gap() -> timedelta:
+    """Longest a sample's reading is held; also how far past a window its closing sample can be"""
+    return timedelta(seconds=settings.usage_max_sample_gap or 2 * settings.usage_sampling_interval)
+
+
+def to_naive_utc(dt: datetime) -> datetime:
+    """Stored timestamps are naive UTC; convert aware request datetimes before comparing"""
+    if dt.tzinfo is not None:
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def floor_hour(dt: datetime) -> datetime:
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def ceil_hour(dt: datetime) -> datetime:
+    floored = floor_hour(dt)
+    return floored if floored == dt else floored + HOUR
+
+
+def floor_day(dt: datetime) -> datetime:
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def ceil_day(dt: datetime) -> datetime:
+    floored = floor_day(dt)
+    return floored if floored == dt else floored + DAY
+
+
+def bucket_fields(ts: datetime) -> dict:
+    """Bucket start times stored on each raw sample so usage queries can group without $dateTrunc"""
+    return {
+        "ts_5min": ts.replace(minute=ts.minute - ts.minute % 5, second=0, microsecond=0),
+        "ts_hour": floor_hour(ts),
+        "ts_day": floor_day(ts)
+    }
+
+
+def split_period(
+    period_start: datetime,
+    period_end: datetime,
+    complete_until: Optional[datetime],
+    daily: bool = False
+) -> Tuple[Optional[Tuple[datetime, datetime]], List[Tuple[datetime, datetime]]]:
+    """Split a period into the whole hours (or days) served by rollups and the raw remainder.
+
+    Returns (rolled, raw): rolled is an hour- (or day-) aligned (start, end) range
+    or None, raw is the list of (start, end) ranges to integrate from raw samples.
+    """
+    floor, ceil = (floor_day, ceil_day) if daily else (floor_hour, ceil_hour)
+    rolled_start = ceil(period_start)
+    rolled_end = floor(period_end)
+    if complete_until is not None:
+        rolled_end = min(rolled_end, floor(complete_until))
+
+    if complete_until is None or rolled_start >= rolled_end:
+        return None, [(period_start, period_end)]
+
+    raw = [
+        (start, end)
+        for start, end in ((period_start, rolled_start), (rolled_end, period_end))
+        if start < end
+    ]
+    return (rolled_start, rolled_end), raw
+
+
+def dirty_ranges(hours: List[datetime]) -> List[Tuple[datetime, datetime]]:
+    """Hour-aligned ranges to re-roll after late samples landed in `hours`.
+
+    A late sample also closes its predecessor's interval, so the hour before each
+    dirty hour is re-rolled too; overlapping and adjacent ranges are merged.
+    """
+    ranges: List[List[datetime]] = []
+    for hour in sorted(hours):
+        start, end = hour - HOUR, hour + HOUR
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    return [(start, end) for start, end in ranges]
+
+
+def late_sample_hours_pipeline(after_id, up_to_id, complete_until: datetime) -> list:
+    """Aggregation on usage_samples listing the hours of samples inserted in
+    (after_id, up_to_id] whose ts is below the rollup watermark, or close enough
+    past it to close the interval of a sample that is"""
+    return [
+        {"$match": {
+            "_id": {"$gt": after_id, "$lte": up_to_id},
+            "ts": {"$lt": complete_until + max_sample_gap()}
+        }},
+        {"$group": {"_id": {"$dateTrunc": {"date": "$ts", "unit": "hour"}}}}
+    ]
+
+
+def interval_stages(match: dict, end: datetime) -> list:
+    """Stages that turn raw samples into held intervals starting before `end`.
+
+    `match` should select samples up to max_sample_gap() past `end` so that the
+    interval of the last sample before `end` is closed by its successor. Capping
+    intervals at the gap makes them independent of any samples further out, so
+    raw and rolled-up integrations of the same samples agree.
+    """
+    max_gap_ms = max_sample_gap() // timedelta(milliseconds=1)
+    return [
+        {"$match": match},
+        {
+            "$setWindowFields": {
+                "partitionBy": "$server_id",
+                "sortBy": {"ts": 1},
+                "output": {"next_ts": {"$shift": {"output": "$ts", "by": 1}}}
+            }
+        },
+        {"$match": {"ts": {"$lt": end}}},
+        {
+            # Date subtraction yields milliseconds, null for the last sample
+            "$set": {"dt_h": {"$divide": [
+                {"$min": [{"$ifNull": [{"$subtract": ["$next_ts", "$ts"]}, max_gap_ms]}, max_gap_ms]},
+                3600000
+            ]}}
+        }
+    ]
+
+
+def hourly_rollup_pipeline(since: datetime, until: datetime) -> list:
+    """Aggregation on usage_samples that (re)writes the hourly rollups for [since, until)."""
+    match = {"ts": {"$gte": since, "$lt": until + max_sample_gap()}}
+    return interval_stages(match, until) + [
+        {
+            "$group": {
+                "_id": {
+                    "server_id": "$server_id",
+                    "ts": {"$dateTrunc": {"date": "$ts", "unit": "hour"}}
+                },
+                **INTERVAL_TOTALS,
+                **SAMPLE_SUMS
+            }
+        },
+        *_merge_rollup_stages(ROLLUP_COLLECTION)
+    ]
+
+
+def daily_rollup_pipeline(since: datetime, until: datetime) -> list:
+    """Aggregation on the hourly rollups that (re)writes the daily rollups for the days in [since, until)"""
+    return [
+        {"$match": {"ts": {"$gte": floor_day(since), "$lt": until}}},
+        {
+            "$group": {
+                "_id": {
+                    "server_id": "$server_id",
+                    "ts": {"$dateTrunc": {"date": "$ts", "unit": "day"}}
+                },
+                **{field: {"$sum": f"${field}"} for field in ROLLUP_FIELDS}
+            }
+        },
+        *_merge_rollup_stages(DAILY_ROLLUP_COLLECTION)
+    ]
+
+
+def _merge_rollup_stages(collection: str) -> list:
+    return [
+        {
+            "$project": {
+                "_id": 0,
+                "server_id": "$_id.server_id",
+                "ts": "$_id.ts",
+                **{field: 1 for field in ROLLUP_FIELDS}
+            }
+        },
+        {
+            "$merge": {
+                "into": collection,
+                "on": ["server_id", "ts"],
+                "whenMatched": "replace",
+                "whenNotMatched": "insert"
+            }
+        }
+    ]
+
+
+def sample_sums_pipeline(
+    server_ids: List[str],
+    period_start: datetime,
+    period_end: datetime,
+    complete_until: Optional[datetime]
+) -> Tuple[str, list]:
+    """Aggregation returning per-server sample sums and counts (SAMPLE_SUMS) over a period.
+
+    Returns (collection, pipeline): whole hours come from the hourly rollups, with
+    raw samples for the remainder joined by $unionWith.
+    """
+    rolled, raw = split_period(period_start, period_end, complete_until)
+    raw_stages = [
+        {
+            "$match": {
+                "server_id": {"$in": server_ids},
+                "$or": [{"ts": {"$gte": start, "$lt": end}} for start, end in raw]
+            }
+        },
+        {"$group": {"_id": "$server_id", **SAMPLE_SUMS}}
+    ]
+    if not rolled:
+        return "usage_samples", raw_stages
+
+    # Summing already-summed fields; `_id` is the server id after the first $group
+    resum = {field: {"$sum": f"${field}"} for field in SAMPLE_SUMS}
+    pipeline = [
+        {"$match": {"server_id": {"$in": server_ids}, "ts": {"$gte": rolled[0], "$lt": rolled[1]}}},
+        {"$group": {"_id": "$server_id", **resum}}
+    ]
+    if raw:
+        pipeline += [
+            {"$unionWith": {"coll": "usage_samples", "pipeline": raw_stages}},
+            {"$group": {"_id": "$_id", **resum}}
+        ]
+    return ROLLUP_COLLECTION, pipeline
+
+
+async def get_rollup_state(db) -> Optional[dict]:
+    return await db.rollup_state.find_one({"_id": ROLLUP_STATE_ID})
+
+
+async def get_rollup_watermark(db) -> Optional[datetime]:
+    """Hour up to which the rollup collection is complete, or None before the first run"""
+    state = await get_rollup_state(db)
+    return state["complete_until"] if state else None
+
+
+def servers_usage_pipeline(
+    user_id: str,
+    period_start: datetime,
+    period_end: datetime,
+    complete_until: Optional[datetime]
+) -> list:
+    """Aggregation on servers returning each of a user's servers with its usage totals.
+
+    Rollups for whole hours and raw samples for the remainder are joined with one
+    $lookup per range, so the servers and their usage come back in one round-trip.
+    """
+    rolled, raw = split_period(to_naive_utc(period_start), to_naive_utc(period_end), complete_until)
+
+    lookups = []
+    for start, end in raw:
+        lookups.append({
+            "from": "usage_samples",
+            "pipeline": interval_stages({"ts": {"$gte": start, "$lt": end + max_sample_gap()}}, end) + [
+                {"$group": {"_id": None, **INTERVAL_TOTALS}}
+            ]
+        })
+    if rolled:
+        lookups.append({
+            "from": ROLLUP_COLLECTION,
+            "pipeline": [
+                {"$match": {"ts": {"$gte": rolled[0], "$lt": rolled[1]}}},
+                {"$group": {"_id": None, **ROLLUP_TOTALS}}
+            ]
+        })
+
+    pipeline = [
+        {"$match": {"user_id": user_id}},
+        {"$project": {"_id": 0, "id": 1, "cores": 1, "disk_gib": 1}}
+    ]
+    for i, lookup in enumerate(lookups):
+        pipeline.append({
+            "$lookup": {"localField": "id", "foreignField": "server_id", "as": f"usage_{i}", **lookup}
+        })
+    pipeline.append({
+        "$project": {
+            "id": 1,
+            "cores": 1,
+            "disk_gib": 1,
+            **{
+                field: {"$sum": {"$concatArrays": [f"$usage_{i}.{field}" for i in range(len(lookups))]}}
+                for field in INTERVAL_TOTALS
+            }
+        }
+    })
+    return pipeline
+
+
+async def servers_with_usage(
+    db, user_id: str, period_start: datetime, period_end: datetime
+) -> List[dict]:
+    """A user's servers (id, cores, disk_gib) with usage totals over [period_start, period_end)"""
+    complete_until = await get_rollup_watermark(db)
+    pipeline = servers_usage_pipeline(user_id, period_start, period_end, complete_until)
+    return await db.servers.aggregate(pipeline).to_list(length=None)
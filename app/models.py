@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, ConfigDict, Field, EmailStr
 from typing import Optional, List, Dict, Any
 from datetime import datetime
 from enum import Enum
@@ -12,10 +12,12 @@ class UserProvider(str, Enum):
 
 
 class ServerStatus(str, Enum):
+    PENDING = "pending"  # a container operation is queued or in progress
     CREATED = "created"
     RUNNING = "running"
     STOPPED = "stopped"
     DELETED = "deleted"
+    FAILED = "failed"  # container creation or resize failed
 
 
 class InvoiceStatus(str, Enum):
@@ -31,8 +33,14 @@ class TransactionMethod(str, Enum):
     PAYPAL = "paypal"
 
 
+# Documents stored in MongoDB carry an `_id`; ignore it and any fields from older schemas
+MONGO_MODEL_CONFIG = ConfigDict(extra="ignore", populate_by_name=True)
+
+
 # User Models
 class UserBase(BaseModel):
+    model_config = MONGO_MODEL_CONFIG
+
     email: EmailStr
     name: str
     provider: UserProvider
@@ -44,7 +52,7 @@ class UserCreate(UserBase):
 
 
 class UserInDB(UserBase):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     password_hash: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -56,6 +64,8 @@ class User(UserBase):
 
 # Server Models
 class ServerBase(BaseModel):
+    model_config = MONGO_MODEL_CONFIG
+
     name: str
     image: str
     cpu_limit: float
@@ -77,7 +87,7 @@ class ServerUpdate(BaseModel):
 
 
 class ServerInDB(ServerBase):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     user_id: str
     status: ServerStatus = ServerStatus.CREATED
     container_id: Optional[str] = None
@@ -96,7 +106,9 @@ class Server(ServerBase):
 
 # Usage Models
 class UsageSample(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    model_config = MONGO_MODEL_CONFIG
+
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     server_id: str
     ts: datetime = Field(default_factory=datetime.utcnow)
     cpu_pct: float
@@ -106,6 +118,8 @@ class UsageSample(BaseModel):
 
 # Billing Models
 class LineItem(BaseModel):
+    model_config = MONGO_MODEL_CONFIG
+
     kind: str  # "vCPU", "RAM", "Disk"
     unit: str  # "core-hour", "gib-hour"
     quantity: float
@@ -114,13 +128,15 @@ class LineItem(BaseModel):
 
 
 class InvoiceBase(BaseModel):
+    model_config = MONGO_MODEL_CONFIG
+
     user_id: str
     period_start: datetime
     period_end: datetime
 
 
 class InvoiceInDB(InvoiceBase):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     line_items: List[LineItem] = []
     subtotal: float = 0.0
     total: float = 0.0
@@ -138,13 +154,15 @@ class Invoice(InvoiceBase):
 
 
 class TransactionBase(BaseModel):
+    model_config = MONGO_MODEL_CONFIG
+
     invoice_id: str
     amount: float
     method: TransactionMethod
 
 
 class TransactionInDB(TransactionBase):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     ts: datetime = Field(default_factory=datetime.utcnow)
 
 
@@ -187,6 +205,8 @@ class SuccessResponse(BaseModel):
 
 # Billing Rates
 class BillingRates(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     vcpu_rate_per_core_hour: float
     ram_rate_per_gib_hour: float
     disk_rate_per_gib_hour: float
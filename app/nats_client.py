@@ -1,5 +1,5 @@
 import asyncio
-import json
+import orjson
 from typing import Dict, Any
 from nats import connect as nats_connect
 from app.config import settings
@@ -11,10 +11,18 @@ logger = logging.getLogger(__name__)
 class NATSClient:
     def __init__(self):
         self.nc = None
+        self._connect_lock = asyncio.Lock()
+        # Fire-and-forget publishes still in flight; holding them stops the tasks being collected
+        self._pending = set()
     
     async def connect(self):
         try:
-            self.nc = await nats_connect(settings.nats_url)
+            # The client reconnects on its own after transient disconnects
+            self.nc = await nats_connect(
+                settings.nats_url,
+                max_reconnect_attempts=settings.nats_max_reconnect_attempts,
+                reconnect_time_wait=settings.nats_reconnect_time_wait,
+            )
             logger.info("Connected to NATS server")
         except Exception as e:
             logger.error(f"Failed to connect to NATS: {e}")
@@ -22,32 +30,52 @@ class NATSClient:
     
     async def close(self):
        
+        # Let in-flight background publishes finish before the connection goes away
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
         if self.nc:
             await self.nc.close()
     
+    # Connect only if there is no usable connection; the lock stops concurrent callers connecting twice
+    async def _ensure_connected(self):
+        async with self._connect_lock:
+            if self.nc is None or self.nc.is_closed:
+                await self.connect()
+    
     # Publish an event to NATS
     async def publish_event(self, subject: str, data: Dict[str, Any]):
         
         try:
-            if not self.nc:
-                await self.connect()
-            
-            message = json.dumps(data, default=str)
-            await self.nc.publish(subject, message.encode())
+            # orjson encodes datetimes natively and returns bytes ready to publish
+            message = orjson.dumps(data, default=str)
+            try:
+                await self.nc.publish(subject, message)
+            except Exception:
+                if self.nc is not None and not self.nc.is_closed:
+                    raise
+                # Never connected or connection closed for good: connect once and retry
+                await self._ensure_connected()
+                await self.nc.publish(subject, message)
             logger.info(f"Published event to {subject}: {data}")
         except Exception as e:
             logger.error(f"Failed to publish event to {subject}: {e}")
     
+    # Schedule a publish without waiting for it; publish_event logs its own failures
+    def publish_nowait(self, publish):
+        task = asyncio.create_task(publish)
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        return task
+    
     # Subscribe to events from NATS
     async def subscribe_to_events(self, subject: str, handler):
         
         try:
-            if not self.nc:
-                await self.connect()
+            await self._ensure_connected()
             
             async def message_handler(msg):
                 try:
-                    data = json.loads(msg.data.decode())
+                    data = orjson.loads(msg.data)
                     await handler(data)
                 except Exception as e:
                     logger.error(f"Error handling message from {subject}: {e}")
@@ -62,6 +90,11 @@ class NATSClient:
 nats_client = NATSClient()
 
 
+def publish_nowait(publish):
+    """Run a publish_* coroutine in the background, off the request path"""
+    return nats_client.publish_nowait(publish)
+
+
 
 async def publish_server_created(server_id: str):
     """Publish server created event"""
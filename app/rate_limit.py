@@ -0,0 +1,11 @@
+from slowapi import Limiter
+from slowapi.util import get_remote_address
+from app.config import settings
+
+# Per-IP limits for expensive routes (password hashing, OAuth exchanges, invoice aggregation).
+# If the shared storage is unreachable, counting falls back to this process's memory.
+limiter = Limiter(
+    key_func=get_remote_address,
+    storage_uri=settings.rate_limit_storage_uri,
+    in_memory_fallback_enabled=True,
+)
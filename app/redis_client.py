@@ -0,0 +1,42 @@
+import redis.asyncio as redis
+import logging
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class RedisClient:
+    def __init__(self):
+        self.client = None
+
+    # Create the shared client; connections are opened lazily from a bounded pool
+    def connect(self) -> redis.Redis:
+        if self.client is None:
+            self.client = redis.from_url(
+                settings.redis_url,
+                db=settings.redis_db,
+                max_connections=settings.redis_max_connections,
+                socket_connect_timeout=settings.redis_socket_timeout,
+                socket_timeout=settings.redis_socket_timeout,
+                decode_responses=True,
+            )
+            logger.info("Created shared Redis client")
+        return self.client
+
+    async def close(self):
+
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+
+    def get_client(self) -> redis.Redis:
+        """Return the shared client, creating it on first use"""
+        return self.connect()
+
+
+redis_client = RedisClient()
+
+
+# FastAPI dependency returning the shared client
+async def get_redis() -> redis.Redis:
+    return redis_client.get_client()
@@ -7,22 +7,65 @@ from app.models import (
 from app.auth import (
     authenticate_user, create_user, get_user_by_email,
     create_access_token, get_current_user, get_or_create_oauth_user,
-    get_google_user_info, get_github_user_info
+    get_google_user_info, get_github_user_info, hash_password
 )
 from app.database import get_database
+from app.http_client import get_http_client
+from app.redis_client import get_redis
 from app.config import settings
+from app.rate_limit import limiter
 from datetime import timedelta
+from urllib.parse import urlencode
 import httpx
 import secrets
 
 router = APIRouter(prefix="", tags=["Authentication"])
 
+GOOGLE_REDIRECT_URI = "http://localhost:8000/auth/oauth/google/callback"
+GITHUB_REDIRECT_URI = "http://localhost:8000/auth/oauth/github/callback"
+
+# Static parts of the provider authorization URLs; only `state` varies per request
+GOOGLE_AUTH_URL = "https://accounts.google.com/o/oauth2/v2/auth?" + urlencode({
+    "client_id": settings.google_client_id,
+    "redirect_uri": GOOGLE_REDIRECT_URI,
+    "response_type": "code",
+    "scope": "openid email profile",
+})
+GITHUB_AUTH_URL = "https://github.com/login/oauth/authorize?" + urlencode({
+    "client_id": settings.github_client_id,
+    "redirect_uri": GITHUB_REDIRECT_URI,
+    "scope": "user:email",
+})
+
+# Issued OAuth states live in Redis until used once or expired
+OAUTH_STATE_TTL_SECONDS = 600
+
+
+def oauth_state_key(provider: str, state: str) -> str:
+    return f"oauth_state:{provider}:{state}"
+
+
+async def issue_oauth_state(provider: str, redis) -> str:
+    state = secrets.token_urlsafe(32)
+    await redis.set(oauth_state_key(provider, state), "1", nx=True, ex=OAUTH_STATE_TTL_SECONDS)
+    return state
+
+
+async def consume_oauth_state(provider: str, state: str, redis):
+    """Reject callbacks whose state was not issued here, has expired, or was already used"""
+    if not state or not await redis.getdel(oauth_state_key(provider, state)):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid or expired OAuth state"
+        )
+
 
 @router.post("/signup", response_model=Token)
-async def signup(request: SignupRequest, db=Depends(get_database)):
+@limiter.limit(settings.rate_limit_auth)
+async def signup(request: Request, signup_data: SignupRequest, db=Depends(get_database)):
     """Sign up a new user with email and password"""
     # Check if user already exists
-    existing_user = await get_user_by_email(request.email, db)
+    existing_user = await get_user_by_email(signup_data.email, db)
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -30,13 +73,12 @@ async def signup(request: SignupRequest, db=Depends(get_database)):
         )
     
     # Create new user
-    from app.auth import get_password_hash
     user_data = {
-        "email": request.email,
-        "name": request.name,
+        "email": signup_data.email,
+        "name": signup_data.name,
         "provider": "email",
         "provider_id": None,
-        "password_hash": get_password_hash(request.password)
+        "password_hash": await hash_password(signup_data.password)
     }
     
     user = await create_user(user_data, db)
@@ -51,9 +93,10 @@ async def signup(request: SignupRequest, db=Depends(get_database)):
 
 
 @router.post("/login", response_model=Token)
-async def login(request: LoginRequest, db=Depends(get_database)):
+@limiter.limit(settings.rate_limit_auth)
+async def login(request: Request, login_data: LoginRequest, db=Depends(get_database)):
     """Login with email and password"""
-    user = await authenticate_user(request.email, request.password, db)
+    user = await authenticate_user(login_data.email, login_data.password, db)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -70,10 +113,14 @@ async def login(request: LoginRequest, db=Depends(get_database)):
 
 
 @router.get("/oauth/google/callback")
+@limiter.limit(settings.rate_limit_oauth_callback)
 async def google_oauth_callback(
+    request: Request,
     code: str,
     state: str = None,
-    db=Depends(get_database)
+    db=Depends(get_database),
+    client: httpx.AsyncClient = Depends(get_http_client),
+    redis=Depends(get_redis)
 ):
     """Handle Google OAuth callback"""
     if not settings.google_client_id or not settings.google_client_secret:
@@ -82,31 +129,32 @@ async def google_oauth_callback(
             detail="Google OAuth not configured"
         )
     
+    await consume_oauth_state("google", state, redis)
+    
     try:
         # Exchange code for access token
-        async with httpx.AsyncClient() as client:
-            token_response = await client.post(
-                "https://oauth2.googleapis.com/token",
-                data={
-                    "client_id": settings.google_client_id,
-                    "client_secret": settings.google_client_secret,
-                    "code": code,
-                    "grant_type": "authorization_code",
-                    "redirect_uri": "http://localhost:8000/auth/oauth/google/callback"
-                }
+        token_response = await client.post(
+            "https://oauth2.googleapis.com/token",
+            data={
+                "client_id": settings.google_client_id,
+                "client_secret": settings.google_client_secret,
+                "code": code,
+                "grant_type": "authorization_code",
+                "redirect_uri": GOOGLE_REDIRECT_URI
+            }
+        )
+        
+        if token_response.status_code != 200:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Failed to exchange code for token"
             )
-            
-            if token_response.status_code != 200:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Failed to exchange code for token"
-                )
-            
-            token_data = token_response.json()
-            access_token = token_data["access_token"]
+        
+        token_data = token_response.json()
+        access_token = token_data["access_token"]
         
         # Get user info from Google
-        user_info = await get_google_user_info(access_token)
+        user_info = await get_google_user_info(access_token, client)
         
         # Get or create user
         user = await get_or_create_oauth_user(
@@ -133,10 +181,14 @@ async def google_oauth_callback(
 
 
 @router.get("/oauth/github/callback")
+@limiter.limit(settings.rate_limit_oauth_callback)
 async def github_oauth_callback(
+    request: Request,
     code: str,
     state: str = None,
-    db=Depends(get_database)
+    db=Depends(get_database),
+    client: httpx.AsyncClient = Depends(get_http_client),
+    redis=Depends(get_redis)
 ):
     """Handle GitHub OAuth callback"""
     if not settings.github_client_id or not settings.github_client_secret:
@@ -145,30 +197,30 @@ async def github_oauth_callback(
             detail="GitHub OAuth not configured"
         )
     
+    await consume_oauth_state("github", state, redis)
+    
     try:
+        token_response = await client.post(
+            "https://github.com/login/oauth/access_token",
+            data={
+                "client_id": settings.github_client_id,
+                "client_secret": settings.github_client_secret,
+                "code": code
+            },
+            headers={"Accept": "application/json"}
+        )
         
-        async with httpx.AsyncClient() as client:
-            token_response = await client.post(
-                "https://github.com/login/oauth/access_token",
-                data={
-                    "client_id": settings.github_client_id,
-                    "client_secret": settings.github_client_secret,
-                    "code": code
-                },
-                headers={"Accept": "application/json"}
+        if token_response.status_code != 200:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Failed to exchange code for token"
             )
-            
-            if token_response.status_code != 200:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Failed to exchange code for token"
-                )
-            
-            token_data = token_response.json()
-            access_token = token_data["access_token"]
+        
+        token_data = token_response.json()
+        access_token = token_data["access_token"]
         
         # Get user info from GitHub
-        user_info = await get_github_user_info(access_token)
+        user_info = await get_github_user_info(access_token, client)
         
         # Get or create user
         user = await get_or_create_oauth_user(
@@ -195,48 +247,33 @@ async def github_oauth_callback(
 
 
 @router.get("/oauth/google")
-async def google_oauth_start():
+async def google_oauth_start(redis=Depends(get_redis)):
     """Start Google OAuth flow - redirect to Google"""
     if not settings.google_client_id:
         raise HTTPException(
             status_code=status.HTTP_501_NOT_IMPLEMENTED,
             detail="Google OAuth not configured"
         )
-    state = secrets.token_urlsafe(32)
-    google_oauth_url = (
-        "https://accounts.google.com/o/oauth2/v2/auth?"
-        f"client_id={settings.google_client_id}&"
-        "redirect_uri=http://localhost:8000/auth/oauth/google/callback&"
-        "response_type=code&"
-        "scope=openid%20email%20profile&"
-        f"state={state}"
-    )
-    return RedirectResponse(url=google_oauth_url)
+    state = await issue_oauth_state("google", redis)
+    return RedirectResponse(url=f"{GOOGLE_AUTH_URL}&state={state}")
 
 
 @router.get("/oauth/github")
-async def github_oauth_start():
+async def github_oauth_start(redis=Depends(get_redis)):
     """Start GitHub OAuth flow - redirect to GitHub"""
     if not settings.github_client_id:
         raise HTTPException(
             status_code=status.HTTP_501_NOT_IMPLEMENTED,
             detail="GitHub OAuth not configured"
         )
-    state = secrets.token_urlsafe(32)
-    github_oauth_url = (
-        "https://github.com/login/oauth/authorize?"
-        f"client_id={settings.github_client_id}&"
-        "redirect_uri=http://localhost:8000/auth/oauth/github/callback&"
-        "scope=user:email&"
-        f"state={state}"
-    )
-    return RedirectResponse(url=github_oauth_url)
+    state = await issue_oauth_state("github", redis)
+    return RedirectResponse(url=f"{GITHUB_AUTH_URL}&state={state}")
 
 
 @router.get("/me", response_model=User)
 async def get_current_user_info(current_user: UserInDB = Depends(get_current_user)):
     """Get current user information"""
-    return User(
+    return User.model_construct(
         id=current_user.id,
         email=current_user.email,
         name=current_user.name,
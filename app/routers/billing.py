@@ -1,156 +1,172 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import ORJSONResponse
+from typing import List, Optional
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from datetime import datetime, timedelta
 from app.models import (
     BillingRates, Invoice, InvoiceGenerateRequest, Transaction, TransactionInDB,
     LineItem, InvoiceStatus, TransactionMethod, ErrorResponse, SuccessResponse
 )
 from app.auth import get_current_user, UserInDB
-from app.database import get_database
+from app.database import get_database, page_query
 from app.config import settings
-from app.nats_client import publish_invoice_generated
+from app.cache import document_cache
+from app.nats_client import publish_invoice_generated, publish_nowait
+from app.rate_limit import limiter
+from app.metering import servers_with_usage
+import asyncio
 import uuid
 
 router = APIRouter(tags=["Billing"])
 
 
+# Rates are fixed for the lifetime of the process; build the model once
+BILLING_RATES = BillingRates(
+    vcpu_rate_per_core_hour=settings.vcpu_rate_per_core_hour,
+    ram_rate_per_gib_hour=settings.ram_rate_per_gib_hour,
+    disk_rate_per_gib_hour=settings.disk_rate_per_gib_hour
+)
+
+
+def invoice_from_doc(invoice_doc: dict) -> Invoice:
+    """Build an outbound Invoice from a stored document without re-validating it"""
+    return Invoice.model_construct(**{
+        **invoice_doc,
+        "line_items": [LineItem.model_construct(**item) for item in invoice_doc["line_items"]]
+    })
+
+
+# Only the fields the response model serialises (plus _id for the cursor)
+INVOICE_PROJECTION = {field: 1 for field in Invoice.model_fields}
+
+
 @router.get("/rates", response_model=BillingRates)
 async def get_billing_rates():
     """Get current billing rates"""
-    return BillingRates(
-        vcpu_rate_per_core_hour=settings.vcpu_rate_per_core_hour,
-        ram_rate_per_gib_hour=settings.ram_rate_per_gib_hour,
-        disk_rate_per_gib_hour=settings.disk_rate_per_gib_hour
-    )
+    return BILLING_RATES
 
 
 @router.post("/invoices/generate", response_model=Invoice)
+@limiter.limit(settings.rate_limit_invoice_generate)
 async def generate_invoice(
-    request: InvoiceGenerateRequest,
+    request: Request,
+    invoice_request: InvoiceGenerateRequest,
     current_user: UserInDB = Depends(get_current_user),
     db=Depends(get_database)
 ):
     """Generate an invoice for a specific period"""
+    now = datetime.utcnow()
    
-    if request.period_start >= request.period_end:
+    if invoice_request.period_start >= invoice_request.period_end:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Period start must be before period end"
         )
     
-    # Check if invoice already exists 
-    existing_invoice = await db.invoices.find_one({
-        "user_id": current_user.id,
-        "period_start": request.period_start,
-        "period_end": request.period_end
-    })
+    # Check if invoice already exists while loading the user's servers with their
+    # usage, integrated in MongoDB from hourly rollups plus raw samples at the edges
+    existing_invoices, servers = await asyncio.gather(
+        db.invoices.count_documents({
+            "user_id": current_user.id,
+            "period_start": invoice_request.period_start,
+            "period_end": invoice_request.period_end
+        }, limit=1),
+        servers_with_usage(
+            db, current_user.id, invoice_request.period_start, invoice_request.period_end
+        )
+    )
     
-    if existing_invoice:
+    if existing_invoices:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invoice already exists for this period"
         )
     
     try:
-        servers = []
-        async for server_doc in db.servers.find({"user_id": current_user.id}):
-            servers.append(server_doc)
-        
         if not servers:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="No servers found for user"
             )
         
+        # Line items are built as the plain dicts stored in Mongo; no intermediate models
         line_items = []
         total_amount = 0.0
+        vcpu_rate = BILLING_RATES.vcpu_rate_per_core_hour
+        ram_rate = BILLING_RATES.ram_rate_per_gib_hour
+        disk_rate = BILLING_RATES.disk_rate_per_gib_hour
         
         for server in servers:
-            server_id = server["id"]
-            
-            usage_samples = []
-            async for sample_doc in db.usage_samples.find({
-                "server_id": server_id,
-                "ts": {
-                    "$gte": request.period_start,
-                    "$lt": request.period_end
-                }
-            }).sort("ts", 1):
-                usage_samples.append(sample_doc)
-            
-            if not usage_samples:
-                continue
-            
             # Calculate resource hours used
-            vcpu_hours = 0.0
-            ram_hours = 0.0
-            disk_hours = 0.0
-            
-            for i in range(len(usage_samples) - 1):
-                current_sample = usage_samples[i]
-                next_sample = usage_samples[i + 1]
-
-                time_diff = (next_sample["ts"] - current_sample["ts"]).total_seconds() / 3600.0
-                
-               
-                vcpu_hours += (current_sample["cpu_pct"] / 100.0) * server["cores"] * time_diff
-                ram_hours += (current_sample["ram_mib"] / 1024.0) * time_diff  # Convert MB to GB
-                disk_hours += server["disk_gib"] * time_diff
+            vcpu_hours = server["cpu_hours"] * server["cores"]
+            ram_hours = server["ram_gib_hours"]
+            disk_hours = server["disk_gib"] * server["span_hours"]
             
             if vcpu_hours > 0:
-                vcpu_amount = vcpu_hours * settings.vcpu_rate_per_core_hour
-                line_items.append(LineItem(
-                    kind="vCPU",
-                    unit="core-hour",
-                    quantity=round(vcpu_hours, 4),
-                    rate=settings.vcpu_rate_per_core_hour,
-                    amount=round(vcpu_amount, 4)
-                ))
+                vcpu_amount = vcpu_hours * vcpu_rate
+                line_items.append({
+                    "kind": "vCPU",
+                    "unit": "core-hour",
+                    "quantity": round(vcpu_hours, 4),
+                    "rate": vcpu_rate,
+                    "amount": round(vcpu_amount, 4)
+                })
                 total_amount += vcpu_amount
             
             if ram_hours > 0:
-                ram_amount = ram_hours * settings.ram_rate_per_gib_hour
-                line_items.append(LineItem(
-                    kind="RAM",
-                    unit="gib-hour",
-                    quantity=round(ram_hours, 4),
-                    rate=settings.ram_rate_per_gib_hour,
-                    amount=round(ram_amount, 4)
-                ))
+                ram_amount = ram_hours * ram_rate
+                line_items.append({
+                    "kind": "RAM",
+                    "unit": "gib-hour",
+                    "quantity": round(ram_hours, 4),
+                    "rate": ram_rate,
+                    "amount": round(ram_amount, 4)
+                })
                 total_amount += ram_amount
             
             if disk_hours > 0:
-                disk_amount = disk_hours * settings.disk_rate_per_gib_hour
-                line_items.append(LineItem(
-                    kind="Disk",
-                    unit="gib-hour",
-                    quantity=round(disk_hours, 4),
-                    rate=settings.disk_rate_per_gib_hour,
-                    amount=round(disk_amount, 4)
-                ))
+                disk_amount = disk_hours * disk_rate
+                line_items.append({
+                    "kind": "Disk",
+                    "unit": "gib-hour",
+                    "quantity": round(disk_hours, 4),
+                    "rate": disk_rate,
+                    "amount": round(disk_amount, 4)
+                })
                 total_amount += disk_amount
         
         # Create invoice
         invoice = {
-            "id": str(uuid.uuid4()),
+            "id": uuid.uuid4().hex,
             "user_id": current_user.id,
-            "period_start": request.period_start,
-            "period_end": request.period_end,
-            "line_items": [item.dict() for item in line_items],
+            "period_start": invoice_request.period_start,
+            "period_end": invoice_request.period_end,
+            "line_items": line_items,
             "subtotal": round(total_amount, 4),
             "total": round(total_amount, 4),  # No taxes for now
             "status": InvoiceStatus.DRAFT,
-            "created_at": datetime.utcnow()
+            "created_at": now
         }
         
        
-        await db.invoices.insert_one(invoice)
+        try:
+            await db.invoices.insert_one(invoice)
+        except DuplicateKeyError:
+            # A concurrent request generated this period first; the unique index caught it
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invoice already exists for this period"
+            )
         
-        # Publish event in NATS
-        await publish_invoice_generated(invoice["id"])
+        # Publish event in NATS without holding up the response
+        publish_nowait(publish_invoice_generated(invoice["id"]))
         
-        return Invoice(**invoice)
+        return invoice_from_doc(invoice)
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -158,17 +174,32 @@ async def generate_invoice(
         )
 
 
+# response_model documents the schema; the handler serialises the page itself
 @router.get("/invoices", response_model=List[Invoice])
 async def list_invoices(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
     current_user: UserInDB = Depends(get_current_user),
     db=Depends(get_database)
 ):
-    """List all invoices for the current user"""
-    invoices = []
-    async for invoice_doc in db.invoices.find({"user_id": current_user.id}).sort("created_at", -1):
-        invoices.append(Invoice(**invoice_doc))
-    
-    return invoices
+    """List invoices for the current user, newest first, one page at a time"""
+    try:
+        query = page_query({"user_id": current_user.id}, cursor, descending=True)
+    except InvalidId:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+    # _id order matches creation order, so this is still newest first
+    invoice_docs = await db.invoices.find(query, INVOICE_PROJECTION).sort("_id", -1).to_list(length=limit)
+    headers = {}
+    if len(invoice_docs) == limit:
+        headers["X-Next-Cursor"] = str(invoice_docs[-1]["_id"])
+
+    # Documents were validated on write; skip re-validation and FastAPI's
+    # jsonable_encoder walk, letting orjson encode the dumped models
+    return ORJSONResponse([invoice_from_doc(doc).model_dump() for doc in invoice_docs], headers=headers)
 
 
 @router.get("/invoices/{invoice_id}", response_model=Invoice)
@@ -178,6 +209,10 @@ async def get_invoice(
     db=Depends(get_database)
 ):
     """Get a specific invoice"""
+    cached_invoice = await document_cache.get_invoice(invoice_id)
+    if cached_invoice is not None and cached_invoice.user_id == current_user.id:
+        return cached_invoice
+    
     invoice_doc = await db.invoices.find_one({
         "id": invoice_id,
         "user_id": current_user.id
@@ -189,7 +224,9 @@ async def get_invoice(
             detail="Invoice not found"
         )
     
-    return Invoice(**invoice_doc)
+    invoice = invoice_from_doc(invoice_doc)
+    await document_cache.set_invoice(invoice)
+    return invoice
 
 
 @router.post("/invoices/{invoice_id}/pay", response_model=Transaction)
@@ -200,51 +237,53 @@ async def pay_invoice(
     db=Depends(get_database)
 ):
     """Record a payment for an invoice (mock payment)"""
-    # Get invoice
-    invoice_doc = await db.invoices.find_one({
-        "id": invoice_id,
-        "user_id": current_user.id
-    })
+    # Mark the invoice paid in one conditional update; the previous state is kept
+    # so the payment can be rolled back if recording the transaction fails
+    invoice = await db.invoices.find_one_and_update(
+        {"id": invoice_id, "user_id": current_user.id, "status": {"$ne": InvoiceStatus.PAID}},
+        {"$set": {"status": InvoiceStatus.PAID}},
+        projection={"_id": 0, "status": 1, "total": 1},
+        return_document=ReturnDocument.BEFORE
+    )
     
-    if not invoice_doc:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Invoice not found"
+    if not invoice:
+        # Only the error branch pays for a second query, to tell the failures apart
+        exists = await db.invoices.count_documents(
+            {"id": invoice_id, "user_id": current_user.id}, limit=1
         )
-    
-    invoice = Invoice(**invoice_doc)
-    
-    if invoice.status == InvoiceStatus.PAID:
+        if not exists:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Invoice not found"
+            )
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invoice is already paid"
         )
     
+    await document_cache.invalidate_invoice(invoice_id)
+    
     try:
 
         transaction = TransactionInDB(
             invoice_id=invoice_id,
-            amount=invoice.total,
+            amount=invoice["total"],
             method=method
         )
         
-        await db.transactions.insert_one(transaction.dict())
-        
-
-        await db.invoices.update_one(
-            {"id": invoice_id},
-            {"$set": {"status": InvoiceStatus.PAID}}
-        )
+        # Dump once; build the response before insert_one adds _id to the document
+        transaction_doc = transaction.model_dump()
+        response = Transaction.model_construct(**transaction_doc)
+        await db.transactions.insert_one(transaction_doc)
         
-        return Transaction(
-            id=transaction.id,
-            invoice_id=transaction.invoice_id,
-            amount=transaction.amount,
-            method=transaction.method,
-            ts=transaction.ts
-        )
+        return response
         
     except Exception as e:
+        await db.invoices.update_one(
+            {"id": invoice_id, "status": InvoiceStatus.PAID},
+            {"$set": {"status": invoice["status"]}}
+        )
+        await document_cache.invalidate_invoice(invoice_id)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to process payment: {str(e)}"
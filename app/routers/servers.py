@@ -1,21 +1,25 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import ORJSONResponse
+from typing import List, Optional
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
 from app.models import (
     Server, ServerCreate, ServerUpdate, ServerInDB, ServerStatus,
     ErrorResponse, SuccessResponse
 )
 from app.auth import get_current_user, UserInDB
-from app.database import get_database
+from app.database import get_database, page_query
 from app.docker_manager import docker_manager
-from app.nats_client import publish_server_created, publish_server_started, publish_server_stopped
+from app.workers.container_worker import container_worker, pending_job
 from app.config import settings
+from app.cache import document_cache
 from datetime import datetime
 import uuid
 
 router = APIRouter(tags=["Servers"])
 
 
-@router.post("", response_model=Server)
+@router.post("", response_model=Server, status_code=status.HTTP_202_ACCEPTED)
 async def create_server(
     server_data: ServerCreate,
     current_user: UserInDB = Depends(get_current_user),
@@ -49,6 +53,8 @@ async def create_server(
             detail=f"Disk size cannot exceed {settings.max_disk_per_server} GiB"
         )
     
+    # One timestamp for both fields, so a fresh server has created_at == updated_at
+    now = datetime.utcnow()
     server = ServerInDB(
         user_id=current_user.id,
         name=server_data.name,
@@ -57,53 +63,52 @@ async def create_server(
         cores=server_data.cores,
         ram_gib=server_data.ram_gib,
         disk_gib=server_data.disk_gib,
-        status=ServerStatus.CREATED
+        status=ServerStatus.PENDING,
+        created_at=now,
+        updated_at=now
     )
     
-    try:
-        # Create Docker container
-        container_id = await docker_manager.create_container(server)
-        server.container_id = container_id
-        
-  
-        await db.servers.insert_one(server.dict())
-        
-        # Publish event in NATS
-        await publish_server_created(server.id)
-        
-        return Server(
-            id=server.id,
-            user_id=server.user_id,
-            name=server.name,
-            image=server.image,
-            cpu_limit=server.cpu_limit,
-            cores=server.cores,
-            ram_gib=server.ram_gib,
-            disk_gib=server.disk_gib,
-            status=server.status,
-            container_id=server.container_id,
-            created_at=server.created_at,
-            updated_at=server.updated_at
-        )
-        
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to create server: {str(e)}"
-        )
+    # The container is created by the container worker, which moves the server
+    # to CREATED (and publishes server.created); clients poll GET /servers/{id}
+    # Dump once; build the response before insert_one adds _id to the document
+    server_doc = server.model_dump()
+    response = Server.model_construct(**server_doc)
+    server_doc["pending_job"] = pending_job("create")
+    await db.servers.insert_one(server_doc)
+    container_worker.submit("create", server.id)
+    
+    return response
+
+
+# Only the fields the response model serialises (plus _id for the cursor)
+SERVER_PROJECTION = {field: 1 for field in Server.model_fields}
 
 
+# response_model documents the schema; the handler serialises the page itself
 @router.get("", response_model=List[Server])
 async def list_servers(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
     current_user: UserInDB = Depends(get_current_user),
     db=Depends(get_database)
 ):
-    """List all servers for the current user"""
-    servers = []
-    async for server_doc in db.servers.find({"user_id": current_user.id}):
-        servers.append(Server(**server_doc))
-    
-    return servers
+    """List servers for the current user, one page at a time"""
+    try:
+        query = page_query({"user_id": current_user.id}, cursor)
+    except InvalidId:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+    server_docs = await db.servers.find(query, SERVER_PROJECTION).sort("_id", 1).to_list(length=limit)
+    headers = {}
+    if len(server_docs) == limit:
+        headers["X-Next-Cursor"] = str(server_docs[-1]["_id"])
+
+    # Documents were validated on write; skip re-validation and FastAPI's
+    # jsonable_encoder walk, letting orjson encode the dumped models
+    return ORJSONResponse([Server.model_construct(**doc).model_dump() for doc in server_docs], headers=headers)
 
 
 @router.get("/{server_id}", response_model=Server)
@@ -113,6 +118,10 @@ async def get_server(
     db=Depends(get_database)
 ):
     """Get a specific server"""
+    cached_server = await document_cache.get_server(server_id)
+    if cached_server is not None and cached_server.user_id == current_user.id:
+        return cached_server
+    
     server_doc = await db.servers.find_one({
         "id": server_id,
         "user_id": current_user.id
@@ -124,131 +133,87 @@ async def get_server(
             detail="Server not found"
         )
     
-    return Server(**server_doc)
+    server = Server.model_construct(**server_doc)
+    await document_cache.set_server(server)
+    return server
 
 
-@router.post("/{server_id}/start", response_model=SuccessResponse)
-async def start_server(
-    server_id: str,
-    current_user: UserInDB = Depends(get_current_user),
-    db=Depends(get_database)
-):
-    """Start a server"""
-    server_doc = await db.servers.find_one({
-        "id": server_id,
-        "user_id": current_user.id
-    })
+async def begin_transition(db, server_id: str, user_id: str, target: ServerStatus, op: str) -> dict:
+    """Atomically mark a server with a container PENDING on its way to `target`.
     
-    if not server_doc:
+    Records `op` and the previous status as the server's pending job, and
+    returns the server's previous state. A second query only runs on the error
+    branch, to tell why nothing matched.
+    """
+    previous = await db.servers.find_one_and_update(
+        {
+            "id": server_id,
+            "user_id": user_id,
+            "status": {"$nin": [target, ServerStatus.PENDING]},
+            "container_id": {"$ne": None}
+        },
+        # Pipeline update so the pending job can capture the status being replaced
+        [{"$set": {
+            "status": ServerStatus.PENDING,
+            "updated_at": datetime.utcnow(),
+            "pending_job": pending_job(op, "$status")
+        }}],
+        projection={"_id": 0, "status": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    if previous:
+        await document_cache.invalidate_server(server_id)
+        return previous
+    
+    server = await db.servers.find_one(
+        {"id": server_id, "user_id": user_id},
+        projection={"_id": 0, "id": 1, "status": 1}
+    )
+    if not server:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Server not found"
         )
-    
-    server = ServerInDB(**server_doc)
-    
-    if server.status == ServerStatus.RUNNING:
+    if server["status"] == target:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Server is already running"
+            detail=f"Server is already {target.value}"
         )
-    
-    if not server.container_id:
+    if server["status"] == ServerStatus.PENDING:
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Server container not found"
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Server has an operation in progress"
         )
+    raise HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="Server container not found"
+    )
+
+
+@router.post("/{server_id}/start", response_model=SuccessResponse, status_code=status.HTTP_202_ACCEPTED)
+async def start_server(
+    server_id: str,
+    current_user: UserInDB = Depends(get_current_user),
+    db=Depends(get_database)
+):
+    """Start a server; the container worker moves it to RUNNING"""
+    previous = await begin_transition(db, server_id, current_user.id, ServerStatus.RUNNING, "start")
+    container_worker.submit("start", server_id, previous["status"])
     
-    try:
-        success = await docker_manager.start_container(server.container_id)
-        if success:
-            await db.servers.update_one(
-                {"id": server_id},
-                {
-                    "$set": {
-                        "status": ServerStatus.RUNNING,
-                        "updated_at": datetime.utcnow()
-                    }
-                }
-            )
-            
-            # Publish event in NATS
-            await publish_server_started(server_id)
-            
-            return SuccessResponse(message="Server started successfully")
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to start server"
-            )
-            
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to start server: {str(e)}"
-        )
+    return SuccessResponse(message="Server start requested")
 
 
-@router.post("/{server_id}/stop", response_model=SuccessResponse)
+@router.post("/{server_id}/stop", response_model=SuccessResponse, status_code=status.HTTP_202_ACCEPTED)
 async def stop_server(
     server_id: str,
     current_user: UserInDB = Depends(get_current_user),
     db=Depends(get_database)
 ):
-    """Stop a server"""
-    server_doc = await db.servers.find_one({
-        "id": server_id,
-        "user_id": current_user.id
-    })
+    """Stop a server; the container worker moves it to STOPPED"""
+    previous = await begin_transition(db, server_id, current_user.id, ServerStatus.STOPPED, "stop")
+    container_worker.submit("stop", server_id, previous["status"])
     
-    if not server_doc:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Server not found"
-        )
-    
-    server = ServerInDB(**server_doc)
-    
-    if server.status == ServerStatus.STOPPED:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Server is already stopped"
-        )
-    
-    if not server.container_id:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Server container not found"
-        )
-    
-    try:
-        success = await docker_manager.stop_container(server.container_id)
-        if success:
-            await db.servers.update_one(
-                {"id": server_id},
-                {
-                    "$set": {
-                        "status": ServerStatus.STOPPED,
-                        "updated_at": datetime.utcnow()
-                    }
-                }
-            )
-            
-            # Publish event in NATS
-            await publish_server_stopped(server_id)
-            
-            return SuccessResponse(message="Server stopped successfully")
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to stop server"
-            )
-            
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to stop server: {str(e)}"
-        )
+    return SuccessResponse(message="Server stop requested")
 
 
 @router.patch("/{server_id}", response_model=Server)
@@ -270,9 +235,14 @@ async def update_server(
             detail="Server not found"
         )
     
-    server = ServerInDB(**server_doc)
+    server = ServerInDB.model_validate(server_doc)
+    if server.status == ServerStatus.PENDING:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Server has an operation in progress"
+        )
     
-    update_data = server_update.dict(exclude_unset=True)
+    update_data = server_update.model_dump(exclude_unset=True)
     if not update_data:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -306,51 +276,47 @@ async def update_server(
             detail=f"Disk size cannot exceed {settings.max_disk_per_server} GiB"
         )
     
+    # The state the update was decided on; the write only applies if it still holds
+    read_state = {"status": server.status, "container_id": server.container_id}
+    
     for field, value in update_data.items():
         setattr(server, field, value)
     
     server.updated_at = datetime.utcnow()
+    update = {**update_data, "updated_at": server.updated_at}
+    
+    # A running server is recreated with the new resources by the container worker
+    resource_fields = ["cpu_limit", "cores", "ram_gib", "disk_gib"]
+    resize = (
+        server.status == ServerStatus.RUNNING
+        and server.container_id is not None
+        and any(field in update_data for field in resource_fields)
+    )
+    if resize:
+        server.status = ServerStatus.PENDING
+        update["status"] = ServerStatus.PENDING
+        update["pending_job"] = pending_job("resize", ServerStatus.RUNNING)
     
     try:
-        # If server is running and resources changed, restart it
-        if server.status == ServerStatus.RUNNING and server.container_id:
-            
-            resource_fields = ["cpu_limit", "cores", "ram_gib", "disk_gib"]
-            if any(field in update_data for field in resource_fields):
-                
-                new_container_id = await docker_manager.update_container_resources(
-                    server.container_id, server
-                )
-                if not new_container_id:
-                    raise HTTPException(
-                        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                        detail="Failed to update server resources"
-                    )
-                
-                # Update the server with the new container ID
-                server.container_id = new_container_id
-        
-
-        await db.servers.update_one(
-            {"id": server_id},
-            {"$set": server.dict()}
+        # Only the changed fields are written, so a concurrent start/stop or worker
+        # completion is never reverted; if one landed since the read, nothing matches
+        result = await db.servers.update_one(
+            {"id": server_id, **read_state},
+            {"$set": update}
         )
+        if not result.matched_count:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Server changed during the update; retry"
+            )
+        await document_cache.invalidate_server(server_id)
+        if resize:
+            container_worker.submit("resize", server_id, ServerStatus.RUNNING)
         
-        return Server(
-            id=server.id,
-            user_id=server.user_id,
-            name=server.name,
-            image=server.image,
-            cpu_limit=server.cpu_limit,
-            cores=server.cores,
-            ram_gib=server.ram_gib,
-            disk_gib=server.disk_gib,
-            status=server.status,
-            container_id=server.container_id,
-            created_at=server.created_at,
-            updated_at=server.updated_at
-        )
+        return Server.model_construct(**dict(server))
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -365,26 +331,26 @@ async def delete_server(
     db=Depends(get_database)
 ):
     """Delete a server"""
-    server_doc = await db.servers.find_one({
-        "id": server_id,
-        "user_id": current_user.id
-    })
+    server = await db.servers.find_one(
+        {"id": server_id, "user_id": current_user.id},
+        projection={"_id": 0, "id": 1, "container_id": 1}
+    )
     
-    if not server_doc:
+    if not server:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Server not found"
         )
     
-    server = ServerInDB(**server_doc)
-    
     try:
         # Delete Docker container if it exists
-        if server.container_id:
-            await docker_manager.delete_container(server.container_id)
+        container_id = server.get("container_id")
+        if container_id:
+            await docker_manager.delete_container(container_id)
         
 
         await db.servers.delete_one({"id": server_id, "user_id": current_user.id})
+        await document_cache.invalidate_server(server_id)
         
         return SuccessResponse(message="Server deleted successfully")
         
@@ -1,28 +1,165 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi.responses import Response
 from typing import List, Optional
 from datetime import datetime, timedelta
+import orjson
 from app.models import UsageSample, ErrorResponse
 from app.auth import get_current_user, UserInDB
 from app.database import get_database
+from app.config import settings
+from app.cache import usage_cache
+from app.metering import (
+    BUCKET_FIELDS, DAILY_ROLLUP_COLLECTION, ROLLUP_COLLECTION, get_rollup_watermark, split_period,
+    to_naive_utc
+)
 
 router = APIRouter(tags=["Usage"])
 
 
+# Documents fetched per cursor round-trip
+USAGE_BATCH_SIZE = 1000
+
+# Intervals served from pre-aggregated rollups
+ROLLUPS = {"1h": ROLLUP_COLLECTION, "1d": DAILY_ROLLUP_COLLECTION}
+
+
+def raw_usage_pipeline(server_id: str, ts_match: dict, interval: str) -> list:
+    """Stages on usage_samples returning raw samples (1m) or their averages per bucket"""
+    pipeline = [
+        {
+            "$match": {
+                "server_id": server_id,
+                **ts_match
+            }
+        }
+    ]
+
+    if interval != "1m":
+        field, trunc = BUCKET_FIELDS[interval]
+        pipeline.extend([
+            {
+                "$group": {
+                    # Samples written before bucket fields existed fall back to $dateTrunc
+                    "_id": {"$ifNull": [f"${field}", {"$dateTrunc": {"date": "$ts", **trunc}}]},
+                    "cpu_pct": {"$avg": "$cpu_pct"},
+                    "ram_mib": {"$avg": "$ram_mib"},
+                    "disk_gib": {"$avg": "$disk_gib"},
+                    "count": {"$sum": 1}
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "ts": "$_id",
+                    "cpu_pct": {"$round": ["$cpu_pct", 2]},
+                    "ram_mib": {"$round": ["$ram_mib", 2]},
+                    "disk_gib": {"$round": ["$disk_gib", 2]},
+                    "sample_count": "$count"
+                }
+            },
+            # $group emits buckets in no particular order
+            {"$sort": {"ts": 1}}
+        ])
+    else:
+        # Raw samples: return only the readings, whatever else is stored on a sample
+        pipeline.extend([
+            {"$sort": {"ts": 1}},
+            {"$project": {"_id": 0, "server_id": 1, "ts": 1, "cpu_pct": 1, "ram_mib": 1, "disk_gib": 1}}
+        ])
+
+    return pipeline
+
+
+def rollup_usage_pipeline(
+    server_id: str, rolled: tuple, raw: list, to_date: datetime, interval: str
+) -> list:
+    """Stages on a rollup collection returning its buckets in `rolled`, plus raw-sample
+    buckets for the `raw` ranges the rollups don't cover"""
+    pipeline = [
+        {"$match": {"server_id": server_id, "ts": {"$gte": rolled[0], "$lt": rolled[1]}}},
+        {
+            "$project": {
+                "_id": 0,
+                "ts": "$ts",
+                "cpu_pct": {"$round": [{"$divide": ["$cpu_pct_sum", "$sample_count"]}, 2]},
+                "ram_mib": {"$round": [{"$divide": ["$ram_mib_sum", "$sample_count"]}, 2]},
+                "disk_gib": {"$round": [{"$divide": ["$disk_gib_sum", "$sample_count"]}, 2]},
+                "sample_count": "$sample_count"
+            }
+        }
+    ]
+    if raw:
+        # The requested range is inclusive of `to`, so the last raw range is too
+        ts_match = {"$or": [
+            {"ts": {"$gte": start, ("$lte" if end == to_date else "$lt"): end}}
+            for start, end in raw
+        ]}
+        pipeline.append({
+            "$unionWith": {"coll": "usage_samples", "pipeline": raw_usage_pipeline(server_id, ts_match, interval)}
+        })
+    pipeline.append({"$sort": {"ts": 1}})
+    return pipeline
+
+
+async def aggregate_usage(
+    db, server_id: str, from_date: datetime, to_date: datetime, interval: str, ts_format: str = "iso"
+) -> List[dict]:
+    """Run the usage aggregation for one server and return its samples or buckets"""
+    from_date, to_date = to_naive_utc(from_date), to_naive_utc(to_date)
+    rolled = None
+    if interval in ROLLUPS:
+        complete_until = await get_rollup_watermark(db)
+        rolled, raw = split_period(from_date, to_date, complete_until, daily=interval == "1d")
+        if rolled and rolled[1] == to_date:
+            # split_period is end-exclusive; keep samples landing exactly on `to`
+            raw.append((to_date, to_date))
+
+    if rolled:
+        collection = db[ROLLUPS[interval]]
+        pipeline = rollup_usage_pipeline(server_id, rolled, raw, to_date, interval)
+    else:
+        collection = db.usage_samples
+        pipeline = raw_usage_pipeline(server_id, {"ts": {"$gte": from_date, "$lte": to_date}}, interval)
+
+    pipeline.append({"$limit": settings.usage_max_points})
+    if ts_format == "epoch_ms":
+        # Converted server-side after $limit, so only returned documents pay for it
+        pipeline.append({"$set": {"ts": {"$toLong": "$ts"}}})
+
+    return await collection.aggregate(
+        pipeline, allowDiskUse=False, batchSize=USAGE_BATCH_SIZE
+    ).to_list(length=None)
+
+
+async def usage_body(
+    db, server_id: str, from_date: datetime, to_date: datetime, interval: str, ts_format: str
+) -> bytes:
+    """The encoded usage response; orjson handles the datetimes, so documents are used as returned"""
+    return orjson.dumps({
+        "server_id": server_id,
+        "from_date": from_date,
+        "to_date": to_date,
+        "interval": interval,
+        "data": await aggregate_usage(db, server_id, from_date, to_date, interval, ts_format)
+    })
+
+
 @router.get("/{server_id}/usage")
 async def get_server_usage(
     server_id: str,
     from_date: Optional[datetime] = Query(None, alias="from"),
     to_date: Optional[datetime] = Query(None, alias="to"),
     interval: str = Query("1h", description="Aggregation interval: 1m, 5m, 1h, 1d"),
+    ts_format: str = Query("iso", description="Sample timestamp format: iso or epoch_ms"),
     current_user: UserInDB = Depends(get_current_user),
     db=Depends(get_database)
 ):
     """Get usage data for a server"""
     # Verify server belongs to user
-    server = await db.servers.find_one({
-        "id": server_id,
-        "user_id": current_user.id
-    })
+    server = await db.servers.find_one(
+        {"id": server_id, "user_id": current_user.id},
+        projection={"_id": 1}
+    )
     
     if not server:
         raise HTTPException(
@@ -30,8 +167,14 @@ async def get_server_usage(
             detail="Server not found"
         )
     
+    # Samples are stored as naive UTC; aware query values (e.g. ...Z) are converted to match
+    if from_date:
+        from_date = to_naive_utc(from_date)
+    if to_date:
+        to_date = to_naive_utc(to_date)
     if not to_date:
-        to_date = datetime.utcnow()
+        # Round "now" to the minute so repeated polls share a cache entry
+        to_date = datetime.utcnow().replace(second=0, microsecond=0)
     if not from_date:
         from_date = to_date - timedelta(days=7)  # Default to last 7 days
 
@@ -41,126 +184,33 @@ async def get_server_usage(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Invalid interval. Must be one of: {valid_intervals}"
         )
+
+    valid_ts_formats = ["iso", "epoch_ms"]
+    if ts_format not in valid_ts_formats:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid ts_format. Must be one of: {valid_ts_formats}"
+        )
+
+    if from_date > to_date:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="'from' must be before 'to'"
+        )
+    if to_date - from_date > timedelta(days=settings.usage_max_range_days):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Date range cannot exceed {settings.usage_max_range_days} days"
+        )
     
     try:
-
-        pipeline = [
-            {
-                "$match": {
-                    "server_id": server_id,
-                    "ts": {
-                        "$gte": from_date,
-                        "$lte": to_date
-                    }
-                }
-            },
-            {
-                "$sort": {"ts": 1}
-            }
-        ]
-        
-        if interval == "1m":
-            pass
-        elif interval == "5m":
-            pipeline.extend([
-                {
-                    "$group": {
-                        "_id": {
-                            "$dateTrunc": {
-                                "date": "$ts",
-                                "unit": "minute",
-                                "binSize": 5
-                            }
-                        },
-                        "cpu_pct": {"$avg": "$cpu_pct"},
-                        "ram_mib": {"$avg": "$ram_mib"},
-                        "disk_gib": {"$avg": "$disk_gib"},
-                        "count": {"$sum": 1}
-                    }
-                },
-                {
-                    "$project": {
-                        "_id": 0,
-                        "ts": "$_id",
-                        "cpu_pct": {"$round": ["$cpu_pct", 2]},
-                        "ram_mib": {"$round": ["$ram_mib", 2]},
-                        "disk_gib": {"$round": ["$disk_gib", 2]},
-                        "sample_count": "$count"
-                    }
-                }
-            ])
-        elif interval == "1h":
-            pipeline.extend([
-                {
-                    "$group": {
-                        "_id": {
-                            "$dateTrunc": {
-                                "date": "$ts",
-                                "unit": "hour"
-                            }
-                        },
-                        "cpu_pct": {"$avg": "$cpu_pct"},
-                        "ram_mib": {"$avg": "$ram_mib"},
-                        "disk_gib": {"$avg": "$disk_gib"},
-                        "count": {"$sum": 1}
-                    }
-                },
-                {
-                    "$project": {
-                        "_id": 0,
-                        "ts": "$_id",
-                        "cpu_pct": {"$round": ["$cpu_pct", 2]},
-                        "ram_mib": {"$round": ["$ram_mib", 2]},
-                        "disk_gib": {"$round": ["$disk_gib", 2]},
-                        "sample_count": "$count"
-                    }
-                }
-            ])
-        elif interval == "1d":
-            pipeline.extend([
-                {
-                    "$group": {
-                        "_id": {
-                            "$dateTrunc": {
-                                "date": "$ts",
-                                "unit": "day"
-                            }
-                        },
-                        "cpu_pct": {"$avg": "$cpu_pct"},
-                        "ram_mib": {"$avg": "$ram_mib"},
-                        "disk_gib": {"$avg": "$disk_gib"},
-                        "count": {"$sum": 1}
-                    }
-                },
-                {
-                    "$project": {
-                        "_id": 0,
-                        "ts": "$_id",
-                        "cpu_pct": {"$round": ["$cpu_pct", 2]},
-                        "ram_mib": {"$round": ["$ram_mib", 2]},
-                        "disk_gib": {"$round": ["$disk_gib", 2]},
-                        "sample_count": "$count"
-                    }
-                }
-            ])
-        
-        usage_data = []
-        async for doc in db.usage_samples.aggregate(pipeline):
-            doc = dict(doc)
-            if "ts" in doc and isinstance(doc["ts"], datetime):
-                doc["ts"] = doc["ts"].isoformat()
- 
-            if "_id" in doc:
-                doc.pop("_id")
-            usage_data.append(doc)
+        # Cached already encoded so hits skip serialisation entirely
+        body = await usage_cache.get_or_load(
+            usage_cache.usage_key(server_id, from_date, to_date, interval, ts_format),
+            lambda: usage_body(db, server_id, from_date, to_date, interval, ts_format)
+        )
         
-        return {
-            "server_id": server_id,
-            "from_date": from_date,
-            "to_date": to_date,
-            "interval": interval,
-            "data": usage_data
-        }
+        return Response(content=body, media_type="application/json")
         
     except Exception as e:
         raise HTTPException(
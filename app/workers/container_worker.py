@@ -0,0 +1,167 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional
+from app.cache import document_cache
+from app.config import settings
+from app.database import get_database
+from app.docker_manager import docker_manager
+from app.models import ServerInDB, ServerStatus
+from app.nats_client import (
+    publish_nowait, publish_server_created, publish_server_started, publish_server_stopped
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ContainerWorker:
+    """Runs Docker lifecycle operations for servers off the request path.
+
+    Routes move a server to PENDING, record the job on it (`pending_job`) and
+    submit it; the worker makes the Docker call and moves the server to its
+    final status. Runs inside the API process, started and stopped by the app
+    lifespan. The queue is in memory, so jobs lost to a crash or a drain timeout
+    are recovered from the recorded `pending_job` of servers left PENDING.
+    """
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        for _ in range(settings.container_worker_concurrency):
+            self._tasks.append(asyncio.create_task(self._consume()))
+        self._tasks.append(asyncio.create_task(self._recover_loop()))
+        logger.info(f"Started {settings.container_worker_concurrency} container workers")
+
+    async def stop(self):
+        # Give queued jobs a chance to finish so servers aren't left PENDING
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=settings.container_worker_drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self.queue.qsize()} container jobs still queued at shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, op: str, server_id: str, previous_status: Optional[ServerStatus] = None):
+        """Queue `op` ("create", "start", "stop" or "resize") for a server already marked PENDING"""
+        self.queue.put_nowait({"op": op, "server_id": server_id, "previous_status": previous_status})
+
+    async def _recover_loop(self):
+        while True:
+            try:
+                await self.recover_stale_jobs()
+            except Exception as e:
+                logger.error(f"Failed to recover stale container jobs: {e}")
+            await asyncio.sleep(settings.container_job_stale_seconds)
+
+    async def recover_stale_jobs(self) -> int:
+        """Re-submit the jobs of servers left PENDING longer than `container_job_stale_seconds`.
+
+        Jobs queued by this or another live API process finish well within the
+        threshold, so only jobs whose process went away are picked up. Each stale
+        server is claimed by bumping updated_at, so only one process re-submits it.
+        """
+        db = await get_database()
+        cutoff = datetime.utcnow() - timedelta(seconds=settings.container_job_stale_seconds)
+        stale = await db.servers.find(
+            {"status": ServerStatus.PENDING, "updated_at": {"$lt": cutoff}},
+            projection={"_id": 0, "id": 1, "container_id": 1, "pending_job": 1, "updated_at": 1}
+        ).to_list(length=None)
+
+        recovered = 0
+        for server in stale:
+            claimed = await db.servers.update_one(
+                {"id": server["id"], "status": ServerStatus.PENDING, "updated_at": server["updated_at"]},
+                {"$set": {"updated_at": datetime.utcnow()}}
+            )
+            if not claimed.modified_count:
+                continue
+            job = server.get("pending_job")
+            if job is None and server.get("container_id") is None:
+                # PENDING from before jobs were recorded; a server without a container was being created
+                job = {"op": "create", "previous_status": None}
+            if job is None:
+                await self._finish(db, server["id"], {"status": ServerStatus.FAILED})
+                continue
+            self.submit(job["op"], server["id"], job.get("previous_status"))
+            recovered += 1
+        if stale:
+            logger.warning(f"Recovered {recovered} of {len(stale)} stale PENDING servers")
+        return recovered
+
+    async def _consume(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._run(job)
+            except Exception as e:
+                logger.error(f"Container job {job['op']} failed for server {job['server_id']}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _run(self, job: dict):
+        db = await get_database()
+        op, server_id = job["op"], job["server_id"]
+
+        server_doc = await db.servers.find_one({"id": server_id, "status": ServerStatus.PENDING})
+        if not server_doc:
+            # Deleted (or otherwise resolved) while the job was queued
+            return
+        server = ServerInDB.model_validate(server_doc)
+
+        try:
+            if op == "create":
+                container_id = await docker_manager.create_container(server)
+                update = {"status": ServerStatus.CREATED, "container_id": container_id}
+                event = publish_server_created
+            elif op == "resize":
+                container_id = await docker_manager.update_container_resources(server.container_id, server)
+                if not container_id:
+                    raise RuntimeError("Failed to update server resources")
+                update = {"status": ServerStatus.RUNNING, "container_id": container_id}
+                event = None
+            elif op == "start":
+                if not await docker_manager.start_container(server.container_id):
+                    raise RuntimeError("Failed to start server")
+                update = {"status": ServerStatus.RUNNING}
+                event = publish_server_started
+            elif op == "stop":
+                if not await docker_manager.stop_container(server.container_id):
+                    raise RuntimeError("Failed to stop server")
+                update = {"status": ServerStatus.STOPPED}
+                event = publish_server_stopped
+            else:
+                raise ValueError(f"Unknown container operation {op}")
+        except Exception as e:
+            logger.error(f"Container job {op} failed for server {server_id}: {e}")
+            # A failed start/stop leaves the container as it was; create/resize may not
+            failed_status = job["previous_status"] if op in ("start", "stop") else ServerStatus.FAILED
+            await self._finish(db, server_id, {"status": failed_status})
+            return
+
+        if not await self._finish(db, server_id, update):
+            # The server was deleted mid-operation; don't leak the container we made
+            if op in ("create", "resize"):
+                await docker_manager.delete_container(update["container_id"])
+            return
+        if event:
+            publish_nowait(event(server_id))
+
+    async def _finish(self, db, server_id: str, update: dict) -> bool:
+        result = await db.servers.update_one(
+            {"id": server_id, "status": ServerStatus.PENDING},
+            {"$set": {**update, "updated_at": datetime.utcnow()}, "$unset": {"pending_job": ""}}
+        )
+        await document_cache.invalidate_server(server_id)
+        return result.modified_count == 1
+
+
+def pending_job(op: str, previous_status: Optional[ServerStatus] = None) -> dict:
+    """The `pending_job` recorded on a server marked PENDING, used to recover lost jobs"""
+    return {"op": op, "previous_status": previous_status}
+
+
+container_worker = ContainerWorker()
@@ -4,10 +4,11 @@ from datetime import datetime, timedelta
 from typing import Optional
 from app.database import connect_to_mongo, get_database
 from app.config import settings
+from app.metering import get_rollup_watermark, sample_sums_pipeline, servers_usage_pipeline
 import aiosmtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from jinja2 import Template
+from jinja2 import Environment
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -64,6 +65,14 @@ EMAIL_TEMPLATE = """
 </html>
 """
 
+# Compiled once; autoescape keeps user-supplied names (user, servers) from injecting HTML
+_EMAIL_TEMPLATE = Environment(autoescape=True).from_string(EMAIL_TEMPLATE)
+
+# Server fields shown in the weekly report
+REPORT_SERVER_PROJECTION = {
+    "_id": 0, "id": 1, "name": 1, "status": 1, "cores": 1, "ram_gib": 1, "disk_gib": 1
+}
+
 # Send an email using SMTP
 async def send_email(to_email: str, subject: str, html_content: str):
     
@@ -101,43 +110,39 @@ async def send_email(to_email: str, subject: str, html_content: str):
         return False
 
 
-async def get_user_servers_with_usage(user_id: str, db, days: int = 7):
+async def get_user_servers_with_usage(
+    user_id: str, db, days: int = 7, complete_until: Optional[datetime] = None
+):
    
     end_date = datetime.utcnow()
     start_date = end_date - timedelta(days=days)
     
-    servers = []
-    async for server_doc in db.servers.find({"user_id": user_id}):
-        server_id = server_doc["id"]
+    server_docs = await db.servers.find({"user_id": user_id}, REPORT_SERVER_PROJECTION).to_list(length=None)
+    if not server_docs:
+        return []
 
-        pipeline = [
-            {
-                "$match": {
-                    "server_id": server_id,
-                    "ts": {"$gte": start_date, "$lte": end_date}
-                }
-            },
-            {
-                "$group": {
-                    "_id": None,
-                    "avg_cpu": {"$avg": "$cpu_pct"},
-                    "avg_ram": {"$avg": "$ram_mib"},
-                    "sample_count": {"$sum": 1}
-                }
-            }
-        ]
-        
-        usage_stats = await db.usage_samples.aggregate(pipeline).to_list(1)
-        
+    # One aggregation for all of the user's servers, mostly answered from the hourly rollups
+    if complete_until is None:
+        complete_until = await get_rollup_watermark(db)
+    collection, pipeline = sample_sums_pipeline(
+        [server_doc["id"] for server_doc in server_docs], start_date, end_date, complete_until
+    )
+    usage_stats = {
+        stats["_id"]: stats async for stats in db[collection].aggregate(pipeline)
+    }
+    
+    servers = []
+    for server_doc in server_docs:
+        stats = usage_stats.get(server_doc["id"])
         server_info = {
             "name": server_doc["name"],
             "status": server_doc["status"],
             "cores": server_doc["cores"],
             "ram_gib": server_doc["ram_gib"],
             "disk_gib": server_doc["disk_gib"],
-            "avg_cpu": round(usage_stats[0]["avg_cpu"], 2) if usage_stats else 0,
-            "avg_ram": round(usage_stats[0]["avg_ram"], 2) if usage_stats else 0,
-            "sample_count": usage_stats[0]["sample_count"] if usage_stats else 0
+            "avg_cpu": round(stats["cpu_pct_sum"] / stats["sample_count"], 2) if stats else 0,
+            "avg_ram": round(stats["ram_mib_sum"] / stats["sample_count"], 2) if stats else 0,
+            "sample_count": stats["sample_count"] if stats else 0
         }
         
         servers.append(server_info)
@@ -145,60 +150,43 @@ async def get_user_servers_with_usage(user_id: str, db, days: int = 7):
     return servers
 
 # Calculate estimated charges for current month
-async def calculate_estimated_charges(user_id: str, db):
+async def calculate_estimated_charges(user_id: str, db, complete_until: Optional[datetime] = None):
 
     now = datetime.utcnow()
     month_start = datetime(now.year, now.month, 1)
     
    
-    servers = []
-    async for server_doc in db.servers.find({"user_id": user_id}):
-        servers.append(server_doc)
-    
-    total_charges = 0.0
-    
-    for server in servers:
-        server_id = server["id"]
-        
-        usage_samples = []
-        async for sample_doc in db.usage_samples.find({
-            "server_id": server_id,
-            "ts": {"$gte": month_start, "$lte": now}
-        }).sort("ts", 1):
-            usage_samples.append(sample_doc)
-        
-        if not usage_samples:
-            continue
-        
-        # Calculate resource hours used
-        vcpu_hours = 0.0
-        ram_hours = 0.0
-        disk_hours = 0.0
-        
-        for i in range(len(usage_samples) - 1):
-            current_sample = usage_samples[i]
-            next_sample = usage_samples[i + 1]
-            
-            time_diff = (next_sample["ts"] - current_sample["ts"]).total_seconds() / 3600.0
-            
-            vcpu_hours += (current_sample["cpu_pct"] / 100.0) * server["cores"] * time_diff
-            ram_hours += (current_sample["ram_mib"] / 1024.0) * time_diff
-            disk_hours += server["disk_gib"] * time_diff
-        
-
-        vcpu_charges = vcpu_hours * settings.vcpu_rate_per_core_hour
-        ram_charges = ram_hours * settings.ram_rate_per_gib_hour
-        disk_charges = disk_hours * settings.disk_rate_per_gib_hour
-        
-        total_charges += vcpu_charges + ram_charges + disk_charges
+    # Integrated (from hourly rollups where available) and priced in MongoDB; one document comes back
+    if complete_until is None:
+        complete_until = await get_rollup_watermark(db)
+    pipeline = servers_usage_pipeline(user_id, month_start, now, complete_until) + [
+        {
+            "$group": {
+                "_id": None,
+                "total_charges": {
+                    "$sum": {
+                        "$add": [
+                            {"$multiply": ["$cpu_hours", "$cores", settings.vcpu_rate_per_core_hour]},
+                            {"$multiply": ["$ram_gib_hours", settings.ram_rate_per_gib_hour]},
+                            {"$multiply": ["$span_hours", "$disk_gib", settings.disk_rate_per_gib_hour]}
+                        ]
+                    }
+                }
+            }
+        }
+    ]
+    result = await db.servers.aggregate(pipeline).to_list(length=1)
+    total_charges = result[0]["total_charges"] if result else 0.0
     
     return round(total_charges, 4)
 
 
 async def get_latest_invoice_link(user_id: str, db):
+    # _id order is creation order, and (user_id, _id) is indexed for invoice listings
     latest_invoice = await db.invoices.find_one(
         {"user_id": user_id},
-        sort=[("created_at", -1)]
+        projection={"id": 1, "_id": 0},
+        sort=[("_id", -1)]
     )
     
     if latest_invoice:
@@ -207,28 +195,28 @@ async def get_latest_invoice_link(user_id: str, db):
         return "http://localhost:8000/billing/invoices"
 
 
-async def send_weekly_email(user_id: str, db):
+async def send_weekly_email(user_id: str, db, complete_until: Optional[datetime] = None):
 
     try:
        
-        user = await db.users.find_one({"id": user_id})
+        user = await db.users.find_one({"id": user_id}, projection={"name": 1, "email": 1, "_id": 0})
         if not user:
             logger.error(f"User {user_id} not found")
             return False
 
-        servers = await get_user_servers_with_usage(user_id, db)
-        
-        estimated_charges = await calculate_estimated_charges(user_id, db)
-
-        invoice_link = await get_latest_invoice_link(user_id, db)
+        # Independent lookups; run them together rather than one after another
+        servers, estimated_charges, invoice_link = await asyncio.gather(
+            get_user_servers_with_usage(user_id, db, complete_until=complete_until),
+            calculate_estimated_charges(user_id, db, complete_until),
+            get_latest_invoice_link(user_id, db)
+        )
 
         now = datetime.utcnow()
         week_start = (now - timedelta(days=7)).strftime("%Y-%m-%d")
         week_end = now.strftime("%Y-%m-%d")
         
 
-        template = Template(EMAIL_TEMPLATE)
-        html_content = template.render(
+        html_content = _EMAIL_TEMPLATE.render(
             user_name=user["name"],
             week_start=week_start,
             week_end=week_end,
@@ -260,16 +248,25 @@ async def weekly_email_worker():
     await connect_to_mongo()
     db = await get_database()
     
+    # Bound concurrent reports so a large user base doesn't exhaust the SMTP and Mongo pools
+    semaphore = asyncio.Semaphore(settings.email_concurrency)
+    
+    async def send_bounded(user_id: str, complete_until: Optional[datetime]):
+        async with semaphore:
+            return await send_weekly_email(user_id, db, complete_until)
+    
     while True:
         try:
             users = []
-            async for user_doc in db.users.find():
+            async for user_doc in db.users.find({}, {"id": 1, "_id": 0}):
                 users.append(user_doc)
             
             logger.info(f"Sending weekly emails to {len(users)} users")
+            # Read once per run instead of once per user
+            complete_until = await get_rollup_watermark(db)
             tasks = []
             for user in users:
-                task = send_weekly_email(user["id"], db)
+                task = send_bounded(user["id"], complete_until)
                 tasks.append(task)
             
             results = await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+from bson import ObjectId
+from app.database import connect_to_mongo, get_database
+from app.metering import (
+    DAY, ROLLUP_COLLECTION, ROLLUP_STATE_ID, daily_rollup_pipeline, dirty_ranges, floor_day, floor_hour,
+    get_rollup_state, hourly_rollup_pipeline, late_sample_hours_pipeline, max_sample_gap
+)
+from app.config import settings
+from app.nats_client import nats_client
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Largest window rolled up by a single aggregation
+ROLLUP_CHUNK = timedelta(days=1)
+
+
+async def set_rollup_watermark(db, complete_until: datetime, scanned_id: ObjectId):
+    await db.rollup_state.update_one(
+        {"_id": ROLLUP_STATE_ID},
+        {"$set": {"complete_until": complete_until, "scanned_id": scanned_id}},
+        upsert=True
+    )
+
+
+def settle_delay() -> timedelta:
+    # An hour is complete once any sample that can close its last interval has
+    # landed: one within the max gap, plus a sampling tick for the write to arrive
+    return max_sample_gap() + timedelta(seconds=settings.usage_sampling_interval)
+
+
+async def roll_chunk(db, since: datetime, until: datetime, days_until: datetime):
+    """(Re)write the hourly rollups for [since, until), then re-sum the days from
+    since's up to days_until from the hourly rollups"""
+    await db.usage_samples.aggregate(
+        hourly_rollup_pipeline(since, until), allowDiskUse=True
+    ).to_list(length=None)
+    await db[ROLLUP_COLLECTION].aggregate(
+        daily_rollup_pipeline(since, days_until), allowDiskUse=True
+    ).to_list(length=None)
+    logger.info(f"Rolled up usage from {since.isoformat()} to {until.isoformat()}")
+
+
+async def reroll(db, since: datetime, until: datetime, complete_until: datetime):
+    """Re-roll already-rolled hours in [since, until) below the watermark `complete_until`"""
+    until = min(until, complete_until)
+    while since < until:
+        chunk_end = min(since + ROLLUP_CHUNK, until)
+        # Days are summed whole (the replace would otherwise drop their later hours)
+        days_until = min(floor_day(chunk_end - timedelta(microseconds=1)) + DAY, complete_until)
+        await roll_chunk(db, since, chunk_end, days_until)
+        since = chunk_end
+
+
+async def rollup_usage(db) -> Optional[datetime]:
+    """Roll complete hours since the watermark into the hourly and daily rollup collections,
+    and re-roll already-rolled hours that received samples since the last run.
+
+    Returns the hour the rollups are now complete up to, or None before any sample exists.
+    """
+    until = floor_hour(datetime.utcnow() - settle_delay())
+
+    # Every sample up to this _id exists before anything below is aggregated;
+    # later inserts are checked for lateness on the next run
+    newest = await db.usage_samples.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    if not newest:
+        # Nothing to roll up; leave the watermark unset so later (backfilled) samples are all rolled up
+        return None
+    scanned_id = newest["_id"]
+
+    state = await get_rollup_state(db)
+    if state is None or "scanned_id" not in state:
+        # First run, rebuild, or state from before late samples were tracked (whose
+        # watermark may have skipped samples): start from the oldest raw sample
+        oldest = await db.usage_samples.find_one({}, {"ts": 1, "_id": 0}, sort=[("ts", 1)])
+        since = floor_hour(oldest["ts"])
+    else:
+        since = state["complete_until"]
+        late_hours = [
+            doc["_id"] async for doc in db.usage_samples.aggregate(
+                late_sample_hours_pipeline(state["scanned_id"], scanned_id, since)
+            )
+        ]
+        for start, end in dirty_ranges(late_hours):
+            logger.info(f"Late samples between {start.isoformat()} and {end.isoformat()}; re-rolling")
+            await reroll(db, start, end, since)
+
+    until = max(until, since)
+    while since < until:
+        chunk_end = min(since + ROLLUP_CHUNK, until)
+        # A partial last day is completed by later chunks
+        await roll_chunk(db, since, chunk_end, chunk_end)
+        await set_rollup_watermark(db, chunk_end, scanned_id)
+        since = chunk_end
+    # Records scanned_id even when no new hour completed
+    await set_rollup_watermark(db, until, scanned_id)
+    return until
+
+
+async def rollup_loop():
+    logger.info("Starting usage rollup worker...")
+
+    await connect_to_mongo()
+    db = await get_database()
+
+    # Samples announce themselves on usage.sampled; the first one that settles a new
+    # hour wakes the loop so that hour is rolled up right away instead of on the next poll
+    due = asyncio.Event()
+    rolled_until = None
+
+    async def on_usage_sampled(data: dict):
+        settled = floor_hour(datetime.fromisoformat(data["ts"]) - settle_delay())
+        if rolled_until is None or settled > rolled_until:
+            due.set()
+
+    # Without NATS the worker still runs on its polling interval
+    await nats_client.subscribe_to_events("usage.sampled", on_usage_sampled)
+
+    while True:
+        due.clear()
+        try:
+            rolled_until = await rollup_usage(db)
+        except Exception as e:
+            logger.error(f"Error in usage rollup loop: {e}")
+
+        try:
+            await asyncio.wait_for(due.wait(), timeout=settings.usage_rollup_interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+if __name__ == "__main__":
+    asyncio.run(rollup_loop())
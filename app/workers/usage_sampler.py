@@ -2,46 +2,79 @@ import asyncio
 import logging
 import uuid
 from datetime import datetime
+from typing import List, Optional
+from pymongo.errors import BulkWriteError
 from app.database import connect_to_mongo, get_database
 from app.docker_manager import docker_manager
 from app.nats_client import nats_client, publish_usage_sampled
 from app.config import settings
+from app.cache import document_cache
+from app.metering import bucket_fields
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-async def sample_server_usage(server_id: str, container_id: str, db):
+async def sample_server_usage(server_id: str, container_id: str) -> Optional[dict]:
+    """Read one running server's container stats; returns the sample to store, or None"""
     try:
-    
-        is_running = await docker_manager.is_container_running(container_id)
-        if not is_running:
-            logger.warning(f"Container {container_id} for server {server_id} is not running or does not exist. Removing server from DB.")
-            await db.servers.delete_one({"id": server_id})
-            return
-        
         stats = await docker_manager.get_container_stats(container_id)
         if stats:
     
+            ts = datetime.utcnow().replace(microsecond=0)
             sample = {
-                "id": str(uuid.uuid4()),
+                "id": uuid.uuid4().hex,
                 "server_id": server_id,
-                "ts": datetime.utcnow(),
+                "ts": ts,
+                **bucket_fields(ts),
                 "cpu_pct": stats["cpu_percent"],
                 "ram_mib": stats["memory_mb"],
                 "disk_gib": stats["disk_gb"]
             }
-      
-            await db.usage_samples.insert_one(sample)
-
-            await publish_usage_sampled(server_id, sample["ts"].isoformat())
             
             logger.info(f"Sampled usage for server {server_id}: CPU={stats['cpu_percent']}%, RAM={stats['memory_mb']}MB")
+            return sample
         else:
             logger.warning(f"Failed to get stats for server {server_id}")
             
     except Exception as e:
         logger.error(f"Error sampling usage for server {server_id}: {e}")
+    return None
+
+
+async def insert_samples(samples: List[dict], db) -> List[dict]:
+    """Insert a tick's samples in one round-trip; returns the ones written"""
+    if not samples:
+        return []
+    try:
+        await db.usage_samples.insert_many(samples, ordered=False)
+    except BulkWriteError as e:
+        # Unordered: everything except the reported failures was written
+        failed = {samples[error["index"]]["id"] for error in e.details["writeErrors"]}
+        logger.error(f"Failed to store {len(failed)} of {len(samples)} usage samples: {e}")
+        samples = [sample for sample in samples if sample["id"] not in failed]
+    return samples
+
+
+async def delete_stale_servers(server_ids: List[str], db):
+    """Remove servers whose containers have disappeared, in one round-trip"""
+    if not server_ids:
+        return
+    await db.servers.delete_many({"id": {"$in": server_ids}})
+    await asyncio.gather(*(document_cache.invalidate_server(server_id) for server_id in server_ids))
+
+
+async def store_tick(samples: List[dict], stale_server_ids: List[str], db):
+    """Apply a tick's writes to both collections concurrently, then announce the samples"""
+    samples, _ = await asyncio.gather(
+        insert_samples(samples, db),
+        delete_stale_servers(stale_server_ids, db)
+    )
+    
+    await asyncio.gather(
+        *(publish_usage_sampled(sample["server_id"], sample["ts"].isoformat()) for sample in samples),
+        return_exceptions=True
+    )
 
 
 async def usage_sampling_loop():
@@ -53,27 +86,47 @@ async def usage_sampling_loop():
     # Connect to NATS
     await nats_client.connect()
     
+    # Bound concurrent samples so a large fleet doesn't exhaust the Mongo pool
+    semaphore = asyncio.Semaphore(settings.usage_sampling_concurrency)
+    
+    async def sample_bounded(server_id: str, container_id: str):
+        async with semaphore:
+            return await sample_server_usage(server_id, container_id)
+    
     while True:
         try:
 
             running_servers = []
-            async for server_doc in db.servers.find({"status": "running"}):
+            async for server_doc in db.servers.find(
+                {"status": "running"}, {"id": 1, "container_id": 1, "_id": 0}
+            ):
                 if server_doc.get("container_id"):
                     running_servers.append(server_doc)
             
             if running_servers:
                 logger.info(f"Sampling usage for {len(running_servers)} running servers")
 
-                tasks = []
-                for server in running_servers:
-                    task = sample_server_usage(
-                        server["id"],
-                        server["container_id"],
-                        db
-                    )
-                    tasks.append(task)
+                # One daemon call tells us which containers are still there
+                running_ids = await docker_manager.running_container_ids()
+                stale_server_ids = []
+                if running_ids is not None:
+                    stale_server_ids = [
+                        server["id"] for server in running_servers
+                        if server["container_id"] not in running_ids
+                    ]
+                    for server_id in stale_server_ids:
+                        logger.warning(f"Container for server {server_id} is not running or does not exist. Removing server from DB.")
                 
-                await asyncio.gather(*tasks, return_exceptions=True)
+                stale = set(stale_server_ids)
+                results = await asyncio.gather(
+                    *(
+                        sample_bounded(server["id"], server["container_id"])
+                        for server in running_servers if server["id"] not in stale
+                    ),
+                    return_exceptions=True
+                )
+                samples = [result for result in results if isinstance(result, dict)]
+                await store_tick(samples, stale_server_ids, db)
             else:
                 logger.info("No running servers to sample")
             
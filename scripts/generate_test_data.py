@@ -8,9 +8,14 @@ import asyncio
 import random
 from datetime import datetime, timedelta
 from app.database import connect_to_mongo, get_database
+from app.metering import HOUR, bucket_fields, floor_hour, get_rollup_watermark
 from app.models import UsageSample
+from app.workers.rollup_worker import reroll, rollup_usage
 import uuid
 
+# Samples written per insert_many round-trip
+INSERT_BATCH_SIZE = 10000
+
 
 async def generate_test_usage_data():
     """Generate test usage data for existing servers"""
@@ -35,6 +40,7 @@ async def generate_test_usage_data():
     # Generate samples every 30 seconds
     current_time = start_time
     sample_count = 0
+    batch = []
     
     while current_time < end_time:
         for server in servers:
@@ -51,14 +57,29 @@ async def generate_test_usage_data():
                 disk_gib=round(disk_gb, 2)
             )
             
-            await db.usage_samples.insert_one(sample.dict())
+            batch.append({**sample.model_dump(), **bucket_fields(sample.ts)})
             sample_count += 1
+            
+            if len(batch) >= INSERT_BATCH_SIZE:
+                await db.usage_samples.insert_many(batch, ordered=False)
+                batch = []
         
         # Move to next sample time (30 seconds later)
         current_time += timedelta(seconds=30)
     
+    if batch:
+        await db.usage_samples.insert_many(batch, ordered=False)
+    
     print(f"Generated {sample_count} usage samples")
     print(f"Time range: {start_time} to {end_time}")
+    
+    # The backfilled hours may already be rolled up; re-roll them explicitly rather
+    # than relying on the worker spotting the late inserts
+    complete_until = await get_rollup_watermark(db)
+    if complete_until is not None:
+        await reroll(db, floor_hour(start_time) - HOUR, complete_until, complete_until)
+    await rollup_usage(db)
+    print("Rolled up usage for the generated samples")
 
 
 async def create_test_user():
@@ -73,7 +94,7 @@ async def create_test_user():
         from app.auth import get_password_hash
         
         test_user = {
-            "id": str(uuid.uuid4()),
+            "id": uuid.uuid4().hex,
             "email": "test@example.com",
             "name": "Test User",
             "provider": "email",
@@ -105,8 +126,9 @@ async def create_test_server():
             print("No users found. Please create a user first.")
             return None
         
+        now = datetime.utcnow()
         test_server = {
-            "id": str(uuid.uuid4()),
+            "id": uuid.uuid4().hex,
             "user_id": user["id"],
             "name": "Test Server",
             "image": "nginx:alpine",
@@ -116,8 +138,8 @@ async def create_test_server():
             "disk_gib": 10.0,
             "status": "running",
             "container_id": f"test-container-{uuid.uuid4()}",
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow()
+            "created_at": now,
+            "updated_at": now
         }
         
         await db.servers.insert_one(test_server)
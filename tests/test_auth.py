@@ -43,6 +43,17 @@ class TestAuth:
         assert token_data is not None
         assert token_data.user_id == user_id
     
+    def test_jwt_token_verification_is_cached(self):
+        """Test repeated verification of the same token reuses the cached result"""
+        token = create_access_token(
+            data={"sub": "cached_user"},
+            expires_delta=timedelta(minutes=30)
+        )
+        
+        first = verify_token(token)
+        second = verify_token(token)
+        assert second is first
+    
     def test_jwt_token_expiration(self):
         """Test JWT token expiration"""
         user_id = "test_user_123"
@@ -0,0 +1,155 @@
+import asyncio
+import time
+from datetime import datetime
+from app.cache import TTLCache, document_cache, usage_cache
+from app.models import Invoice, InvoiceStatus, Server, ServerStatus
+from app.redis_client import redis_client
+
+class TestTTLCache:
+    """Unit tests for the in-memory TTL cache"""
+    
+    def test_get_and_set(self):
+        """Test basic get/set behaviour"""
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("a", 1)
+        
+        assert cache.get("a") == 1
+        assert cache.get("missing") is None
+        assert "a" in cache
+        assert len(cache) == 1
+    
+    def test_lru_eviction(self):
+        """Test least recently used entries are evicted first"""
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.get("c") == 3
+    
+    def test_explicit_expiry(self):
+        """Test entries are refused once their own expiry has passed"""
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("expired", 1, expires_at=time.time() - 1)
+        cache.set("valid", 2, expires_at=time.time() + 30)
+        
+        assert cache.get("expired") is None
+        assert cache.get("valid") == 2
+    
+    def test_pop(self):
+        """Test entries can be invalidated"""
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("a", 1)
+        
+        assert cache.pop("a") == 1
+        assert cache.get("a") is None
+
+
+class TestDocumentCache:
+    """Unit tests for the two-tier server/invoice cache"""
+    
+    def test_fails_open_without_redis(self):
+        """Test the cache degrades to its local tier when Redis is unreachable"""
+        server = Server.model_construct(id="cached-server", user_id="user-1", status=ServerStatus.RUNNING)
+        
+        async def scenario():
+            redis_client.client = None
+            # Point the client at a closed port so every Redis call fails
+            redis_client.connect().connection_pool.connection_kwargs.update(port=1)
+            try:
+                await document_cache.set_server(server)
+                local_hit = await document_cache.get_server("cached-server")
+                await document_cache.invalidate_server("cached-server")
+                after_invalidate = await document_cache.get_server("cached-server")
+            finally:
+                await redis_client.close()
+            return local_hit, after_invalidate
+        
+        local_hit, after_invalidate = asyncio.run(scenario())
+        assert local_hit is server
+        assert after_invalidate is None
+    
+    def test_pending_servers_are_not_cached(self):
+        """Test a PENDING server is never cached, so the worker's final status is read"""
+        server = Server.model_construct(id="pending-server", user_id="user-1", status=ServerStatus.PENDING)
+        
+        async def scenario():
+            redis_client.client = None
+            redis_client.connect().connection_pool.connection_kwargs.update(port=1)
+            try:
+                await document_cache.set_server(server)
+                return await document_cache.get_server("pending-server")
+            finally:
+                await redis_client.close()
+        
+        assert asyncio.run(scenario()) is None
+    
+    def test_only_paid_invoices_are_cached(self):
+        """Test unpaid invoices are read from the database until they are paid"""
+        draft = Invoice.model_construct(id="draft-invoice", user_id="user-1", status=InvoiceStatus.DRAFT)
+        paid = Invoice.model_construct(id="paid-invoice", user_id="user-1", status=InvoiceStatus.PAID)
+        
+        async def scenario():
+            redis_client.client = None
+            redis_client.connect().connection_pool.connection_kwargs.update(port=1)
+            try:
+                await document_cache.set_invoice(draft)
+                await document_cache.set_invoice(paid)
+                cached = [await document_cache.get_invoice(invoice.id) for invoice in (draft, paid)]
+                await document_cache.invalidate_invoice("paid-invoice")
+            finally:
+                await redis_client.close()
+            return cached
+        
+        assert asyncio.run(scenario()) == [None, paid]
+
+
+class TestUsageCache:
+    """Unit tests for the usage query cache"""
+    
+    def test_concurrent_misses_load_once(self):
+        """Test simultaneous requests for the same range share one aggregation"""
+        key = usage_cache.usage_key("server-1", datetime(2024, 1, 1), datetime(2024, 1, 8), "1h")
+        calls = []
+        
+        async def load():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return b'{"data":[{"ts":"2024-01-01T00:00:00","cpu_pct":12.5}]}'
+        
+        async def scenario():
+            usage_cache.clear()
+            try:
+                results = await asyncio.gather(*(usage_cache.get_or_load(key, load) for _ in range(5)))
+                cached = await usage_cache.get_or_load(key, load)
+            finally:
+                usage_cache.clear()
+            return results, cached
+        
+        results, cached = asyncio.run(scenario())
+        assert len(calls) == 1
+        assert all(result is cached for result in results)
+    
+    def test_finished_load_keeps_newer_lock(self):
+        """Test a finishing loader doesn't drop a lock a later caller registered"""
+        key = usage_cache.usage_key("server-2", datetime(2024, 1, 1), datetime(2024, 1, 8), "1h")
+        newer = asyncio.Lock()
+        
+        async def load():
+            # Stands in for a caller that found the key unlocked and registered its own lock
+            usage_cache._loading[key] = newer
+            return b'{"data":[]}'
+        
+        async def scenario():
+            usage_cache.clear()
+            try:
+                await usage_cache.get_or_load(key, load)
+                return usage_cache._loading.get(key)
+            finally:
+                usage_cache._loading.pop(key, None)
+                usage_cache.clear()
+        
+        assert asyncio.run(scenario()) is newer
@@ -0,0 +1,29 @@
+import pytest
+from pytest import approx
+from app.docker_manager import calculate_cpu_percent
+
+class TestCpuPercent:
+    """Unit tests for CPU percentage calculation from Docker stats"""
+    
+    def test_cpu_percent_from_delta(self):
+        """Test CPU usage is scaled by the number of online CPUs"""
+        previous = {"cpu_usage": {"total_usage": 1_000}, "system_cpu_usage": 10_000}
+        current = {"cpu_usage": {"total_usage": 2_000}, "system_cpu_usage": 20_000, "online_cpus": 2}
+        
+        assert calculate_cpu_percent(current, previous) == approx(20.0)
+    
+    def test_cpu_percent_falls_back_to_percpu_usage(self):
+        """Test CPU count falls back to percpu_usage when online_cpus is missing"""
+        previous = {"cpu_usage": {"total_usage": 0}, "system_cpu_usage": 0}
+        current = {
+            "cpu_usage": {"total_usage": 500, "percpu_usage": [250, 250, 0, 0]},
+            "system_cpu_usage": 10_000,
+        }
+        
+        assert calculate_cpu_percent(current, previous) == approx(20.0)
+    
+    def test_cpu_percent_without_previous_sample(self):
+        """Test an empty previous sample (one-shot precpu_stats) yields no usage"""
+        current = {"cpu_usage": {"total_usage": 0}, "system_cpu_usage": 0, "online_cpus": 1}
+        
+        assert calculate_cpu_percent(current, {}) == 0.0
@@ -0,0 +1,185 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from pytest import approx
+from app.metering import (
+    bucket_fields, ceil_hour, dirty_ranges, floor_hour, interval_stages, max_sample_gap,
+    sample_sums_pipeline, servers_usage_pipeline, split_period
+)
+
+
+def evaluate(expr, doc):
+    """Evaluate the aggregation operators used by the dt_h expression against one document"""
+    if isinstance(expr, str) and expr.startswith("$"):
+        return doc.get(expr[1:])
+    if not isinstance(expr, dict):
+        return expr
+    (op, args), = expr.items()
+    values = [evaluate(arg, doc) for arg in args]
+    if op == "$ifNull":
+        return values[0] if values[0] is not None else values[1]
+    if None in values:
+        return None
+    if op == "$subtract":
+        return (values[0] - values[1]) // timedelta(milliseconds=1)
+    if op == "$min":
+        return min(values)
+    if op == "$divide":
+        return values[0] / values[1]
+    raise ValueError(f"Unsupported operator {op}")
+
+class TestSplitPeriod:
+    """Unit tests for splitting billing periods between rollups and raw samples"""
+
+    def test_hour_rounding(self):
+        """Test hours round down and up, leaving aligned times unchanged"""
+        aligned = datetime(2024, 1, 1, 10)
+
+        assert floor_hour(datetime(2024, 1, 1, 10, 30, 15)) == aligned
+        assert ceil_hour(datetime(2024, 1, 1, 9, 0, 1)) == aligned
+        assert ceil_hour(aligned) == aligned
+
+    def test_bucket_fields(self):
+        """Test samples are stamped with the start of their 5 minute, hour and day buckets"""
+        assert bucket_fields(datetime(2024, 1, 1, 10, 37, 15)) == {
+            "ts_5min": datetime(2024, 1, 1, 10, 35),
+            "ts_hour": datetime(2024, 1, 1, 10),
+            "ts_day": datetime(2024, 1, 1)
+        }
+
+    def test_unaligned_period_uses_raw_edges(self):
+        """Test partial hours at both edges are integrated from raw samples"""
+        start = datetime(2024, 1, 1, 9, 30)
+        end = datetime(2024, 1, 2, 9, 30)
+
+        rolled, raw = split_period(start, end, datetime(2024, 2, 1))
+
+        assert rolled == (datetime(2024, 1, 1, 10), datetime(2024, 1, 2, 9))
+        assert raw == [(start, datetime(2024, 1, 1, 10)), (datetime(2024, 1, 2, 9), end)]
+
+    def test_aligned_period_is_fully_rolled_up(self):
+        """Test an hour-aligned period inside the watermark needs no raw samples"""
+        start = datetime(2024, 1, 1)
+        end = datetime(2024, 2, 1)
+
+        assert split_period(start, end, end) == ((start, end), [])
+
+    def test_period_past_watermark_uses_raw_tail(self):
+        """Test hours not yet rolled up are integrated from raw samples"""
+        start = datetime(2024, 1, 1)
+        end = datetime(2024, 2, 1)
+        watermark = datetime(2024, 1, 20, 6)
+
+        assert split_period(start, end, watermark) == ((start, watermark), [(watermark, end)])
+
+    def test_daily_split_uses_whole_days(self):
+        """Test daily splits align to days and stop at the day the watermark falls in"""
+        start = datetime(2024, 1, 1, 9, 30)
+        end = datetime(2024, 1, 10, 12)
+        watermark = datetime(2024, 1, 8, 6)
+
+        rolled, raw = split_period(start, end, watermark, daily=True)
+
+        assert rolled == (datetime(2024, 1, 2), datetime(2024, 1, 8))
+        assert raw == [(start, datetime(2024, 1, 2)), (datetime(2024, 1, 8), end)]
+
+    def test_without_rollups_everything_is_raw(self):
+        """Test periods before the first rollup run or shorter than an hour use raw samples"""
+        start = datetime(2024, 1, 1, 9, 10)
+        end = datetime(2024, 1, 1, 9, 50)
+
+        assert split_period(start, end, None) == (None, [(start, end)])
+        assert split_period(start, end, datetime(2024, 2, 1)) == (None, [(start, end)])
+        assert split_period(datetime(2024, 1, 1), datetime(2024, 2, 1), datetime(2023, 12, 1)) == (
+            None, [(datetime(2024, 1, 1), datetime(2024, 2, 1))]
+        )
+
+
+class TestDirtyRanges:
+    """Unit tests for re-rolling hours that received late samples"""
+
+    def test_includes_previous_hour_and_merges_neighbours(self):
+        """Test each late hour re-rolls its predecessor and adjacent ranges are merged"""
+        hours = [datetime(2024, 1, 1, 12), datetime(2024, 1, 1, 10), datetime(2024, 1, 1, 18)]
+
+        assert dirty_ranges(hours) == [
+            (datetime(2024, 1, 1, 9), datetime(2024, 1, 1, 13)),
+            (datetime(2024, 1, 1, 17), datetime(2024, 1, 1, 19))
+        ]
+
+    def test_no_late_samples(self):
+        """Test nothing is re-rolled without late samples"""
+        assert dirty_ranges([]) == []
+
+
+class TestIntervalStages:
+    """Unit tests for holding sample readings over their intervals"""
+
+    def held_hours(self, ts, next_ts):
+        stages = interval_stages({}, datetime(2024, 1, 2))
+        return evaluate(stages[-1]["$set"]["dt_h"], {"ts": ts, "next_ts": next_ts})
+
+    def test_reading_held_until_next_sample(self):
+        """Test a regular sample is held until its successor"""
+        ts = datetime(2024, 1, 1, 10)
+
+        assert self.held_hours(ts, ts + timedelta(seconds=30)) == approx(30 / 3600)
+
+    def test_stop_restart_gap_is_capped(self):
+        """Test a stop/restart gap bills the same whether or not the restart sample is visible"""
+        ts = datetime(2024, 1, 1, 10, 59, 30)
+        cap = max_sample_gap() / timedelta(hours=1)
+
+        # Rebuilds and raw edges see the restart; incremental rolls ran before it landed
+        assert self.held_hours(ts, ts + timedelta(minutes=40)) == approx(cap)
+        assert self.held_hours(ts, None) == approx(cap)
+
+
+class TestServersUsagePipeline:
+    """Unit tests for the servers + usage aggregation"""
+
+    def test_joins_each_range_once(self):
+        """Test raw edges and rolled-up hours each get one $lookup"""
+        pipeline = servers_usage_pipeline(
+            "user-1", datetime(2024, 1, 1, 9, 30), datetime(2024, 1, 2, 9, 30), datetime(2024, 2, 1)
+        )
+        lookups = [stage["$lookup"] for stage in pipeline if "$lookup" in stage]
+
+        assert pipeline[0] == {"$match": {"user_id": "user-1"}}
+        assert [lookup["from"] for lookup in lookups] == ["usage_samples", "usage_samples", "usage_samples_1h"]
+        assert all(lookup["foreignField"] == "server_id" for lookup in lookups)
+        assert set(pipeline[-1]["$project"]) >= {"cpu_hours", "ram_gib_hours", "span_hours"}
+
+    def test_accepts_timezone_aware_periods(self):
+        """Test Z-suffixed request periods are compared as naive UTC against the watermark"""
+        start = datetime.fromisoformat("2024-01-01T00:00:00+00:00")
+        end = datetime(2024, 1, 31, 23, 59, 59, tzinfo=timezone.utc)
+        watermark = datetime(2024, 2, 1)
+
+        assert servers_usage_pipeline("user-1", start, end, watermark) == servers_usage_pipeline(
+            "user-1", datetime(2024, 1, 1), datetime(2024, 1, 31, 23, 59, 59), watermark
+        )
+
+
+class TestSampleSumsPipeline:
+    """Unit tests for the per-server sample sums aggregation"""
+
+    def test_reads_rollups_with_raw_edges(self):
+        """Test whole hours come from the rollups and partial hours from raw samples"""
+        collection, pipeline = sample_sums_pipeline(
+            ["server-1"], datetime(2024, 1, 1, 9, 30), datetime(2024, 1, 8, 9, 30), datetime(2024, 2, 1)
+        )
+        union = pipeline[2]["$unionWith"]
+
+        assert collection == "usage_samples_1h"
+        assert pipeline[0]["$match"]["ts"] == {"$gte": datetime(2024, 1, 1, 10), "$lt": datetime(2024, 1, 8, 9)}
+        assert union["coll"] == "usage_samples"
+        assert len(union["pipeline"][0]["$match"]["$or"]) == 2
+
+    def test_without_rollups_reads_raw_samples(self):
+        """Test periods before the first rollup run are summed from raw samples alone"""
+        collection, pipeline = sample_sums_pipeline(
+            ["server-1"], datetime(2024, 1, 1), datetime(2024, 1, 8), None
+        )
+
+        assert collection == "usage_samples"
+        assert not any("$unionWith" in stage for stage in pipeline)
@@ -1,6 +1,7 @@
 import pytest
 from fastapi.testclient import TestClient
 from app.main import app
+from app.rate_limit import limiter
 
 class TestSimpleAPI:
     """Simple API tests that don't require database connections"""
@@ -35,6 +36,20 @@ class TestSimpleAPI:
         response = self.client.get("/servers", headers=headers)
         assert response.status_code == 401
     
+    def test_login_rate_limit(self):
+        """Test repeated logins from one client are throttled"""
+        limiter.reset()
+        payload = {"email": "ratelimit@example.com", "password": "wrong-password"}
+        try:
+            for _ in range(5):
+                response = self.client.post("/auth/login", json=payload)
+                assert response.status_code != 429
+            
+            response = self.client.post("/auth/login", json=payload)
+            assert response.status_code == 429
+        finally:
+            limiter.reset()
+    
     def test_docs_endpoint(self):
         """Test that API docs are accessible"""
         response = self.client.get("/docs")